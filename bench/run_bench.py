@@ -0,0 +1,265 @@
+"""
+読み込み処理と表示更新のベンチマーク。
+
+    python bench/run_bench.py --sizes 256,512 --slices 100,300 --syntaxes explicit,rle --output bench_results.json
+
+合成の系列を一時フォルダに書き出し、1ケースごとに別プロセスで計測する（ピークメモリをケースごとに取るため）。
+結果はJSONで書き出すので、バージョン間・マシン間で比較できる
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import itertools
+import subprocess
+import numpy as np
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+SRC_DIR = BENCH_DIR.parent / "src"
+sys.path.insert(0, str(SRC_DIR))
+sys.path.insert(0, str(BENCH_DIR))
+
+from synthetic_series import write_series, TRANSFER_SYNTAXES, MODALITIES
+
+# 表示更新の計測で動かすスライス位置の数（各軸）
+GUI_STEPS = 50
+# 転置コピー（Coronal/Sagittal用）の作成を待つ上限（秒）
+RESLICE_TIMEOUT = 60
+
+def peak_rss_mb() -> float | None:
+    """このプロセスのピークメモリ (MB)"""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 1024**2
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxは KB、macOSは bytes
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+def summarize(times: list[float]) -> dict:
+    """秒のリストをミリ秒の統計にする"""
+    if not times:
+        return {"n": 0}
+    ms = np.array(times) * 1000
+    return {
+        "n": len(ms),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "max_ms": float(ms.max()),
+    }
+
+def bench_gui(data, folder: Path) -> dict:
+    """ウィンドウを出さずにアプリを組み立て、各コントローラの更新処理を直接呼んで計測する"""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    try:
+        from viewer_interface import DicomViewerApp
+        from reslice_cache import get_reslice_cache
+    except ImportError as e:
+        return {"skipped": f"{e}"}
+
+    result = {}
+    app = DicomViewerApp()
+    try:
+        app.load_folder = folder
+        t0 = time.perf_counter()
+        app._show_data(data)
+        result["show_data_ms"] = (time.perf_counter() - t0) * 1000
+
+        # 2D: 各軸のスライス位置を動かして _update_images を計測（転置コピーの完成を待ってから）
+        cache = get_reslice_cache(data)
+        t0 = time.perf_counter()
+        while cache is not None and not cache.ready and time.perf_counter() - t0 < RESLICE_TIMEOUT:
+            time.sleep(0.01)
+        result["reslice_ready_ms"] = (time.perf_counter() - t0) * 1000
+
+        ctrl = app.modes["2D Slice Mode"]
+        for axis, name in enumerate(["axial", "coronal", "sagittal"]):
+            times = []
+            for pos in np.linspace(0, data.volume.shape[axis] - 1, GUI_STEPS).astype(int):
+                ctrl.current_pos[axis] = int(pos)
+                t0 = time.perf_counter()
+                ctrl._update_images()
+                times.append(time.perf_counter() - t0)
+            result[f"slice2d_update_images_{name}"] = summarize(times)
+
+        # ウィンドウ調整
+        times = []
+        for wc in np.linspace(-500, 500, GUI_STEPS):
+            app.slider_wc.value = float(wc)
+            t0 = time.perf_counter()
+            app._update_contrast()
+            times.append(time.perf_counter() - t0)
+        result["update_contrast_2d"] = summarize(times)
+
+        # Ortho: モード切替と断面の移動
+        t0 = time.perf_counter()
+        app.combo_mode.value = "3D Orthogonal Mode"
+        result["switch_to_ortho_ms"] = (time.perf_counter() - t0) * 1000
+        ortho = app.modes["3D Orthogonal Mode"]
+        times = []
+        for z in np.linspace(0, data.volume.shape[0] - 1, GUI_STEPS).astype(int):
+            ortho.slider_z.value = int(z)
+            t0 = time.perf_counter()
+            ortho._update_planes()
+            times.append(time.perf_counter() - t0)
+        result["ortho_update_planes"] = summarize(times)
+
+        times = []
+        for ww in np.linspace(100, 2000, GUI_STEPS):
+            app.slider_ww.value = float(ww)
+            t0 = time.perf_counter()
+            app._update_contrast()
+            times.append(time.perf_counter() - t0)
+        result["update_contrast_ortho"] = summarize(times)
+    except Exception as e:
+        # オフスクリーンでOpenGLが使えない環境など
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        app.viewer.close()
+    return result
+
+def run_case(case: dict) -> dict:
+    """1ケース分（系列の生成は計測に含めない）"""
+    from dicom_loader import load_dicom_files
+    from volume_cache import VolumeCache
+
+    result = {"case": case}
+    workdir = Path(tempfile.mkdtemp(prefix="dicom_bench_"))
+    try:
+        folder = workdir / "series"
+        t0 = time.perf_counter()
+        try:
+            paths = write_series(folder, case["modality"], case["size"], case["size"], case["slices"],
+                                 case["syntax"], case["shuffle"])
+        except Exception as e:
+            # エンコーダが無い圧縮形式など
+            result["skipped"] = f"{type(e).__name__}: {e}"
+            return result
+        result["generate_seconds"] = time.perf_counter() - t0
+        result["bytes_on_disk"] = sum(p.stat().st_size for p in paths)
+        rss_before = peak_rss_mb()
+
+        t0 = time.perf_counter()
+        data = load_dicom_files(paths, max_workers=case.get("workers"))
+        total = time.perf_counter() - t0
+        stats = data.load_stats
+        result["load"] = {
+            "total_seconds": total,
+            "header_seconds": stats.header_seconds,
+            # 展開はボリュームへ直接書き込むので、組み立て（スライスの配置・Rescale）を含む
+            "decode_seconds": stats.decode_seconds,
+            # 残り: ジェネレータの受け渡し・系列データの作成など
+            "other_seconds": total - stats.header_seconds - stats.decode_seconds,
+            "files_per_second": len(paths) / total if total > 0 else None,
+            "decode_by_syntax": stats.decode_by_syntax,
+            "volume_shape": list(data.volume.shape),
+            "volume_dtype": str(data.volume.dtype),
+            "volume_mb": data.volume.nbytes / 1024**2,
+        }
+
+        # キャッシュへの保存と、2回目（キャッシュから）の読み込み
+        cache = VolumeCache(workdir / "cache", max_mb=1 << 20)
+        t0 = time.perf_counter()
+        load_dicom_files(paths, cache=cache)
+        result["cache_store_seconds"] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        load_dicom_files(paths, cache=cache)
+        result["cache_load_seconds"] = time.perf_counter() - t0
+
+        result["peak_rss_mb_before_load"] = rss_before
+        result["peak_rss_mb_load"] = peak_rss_mb()
+        if case.get("gui"):
+            result["gui"] = bench_gui(data, folder)
+            result["peak_rss_mb_total"] = peak_rss_mb()
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def environment() -> dict:
+    import pydicom
+    commit = None
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pydicom": pydicom.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="DICOM Viewer の読み込み・表示更新ベンチマーク")
+    parser.add_argument("--sizes", default="512", help="画像の一辺（カンマ区切り）")
+    parser.add_argument("--slices", default="100", help="スライス枚数（カンマ区切り）")
+    parser.add_argument("--syntaxes", default="explicit", help=f"転送構文 {list(TRANSFER_SYNTAXES)}")
+    parser.add_argument("--modalities", default="CT", help=f"モダリティ {list(MODALITIES)}")
+    parser.add_argument("--no-shuffle", action="store_true", help="ファイル名をスライス順にする")
+    parser.add_argument("--workers", type=int, default=None, help="読み込みのスレッド数（既定は自動）")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--gui", action="store_true", help="napariを使う表示更新の計測も行う")
+    parser.add_argument("--output", default="bench_results.json")
+    # 内部用: 1ケースを実行して結果をファイルへ書く
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        Path(args.result_file).write_text(json.dumps(run_case(json.loads(args.case))), encoding="utf-8")
+        return
+
+    cases = [
+        {"modality": m, "size": int(size), "slices": int(n), "syntax": syntax,
+         "shuffle": not args.no_shuffle, "workers": args.workers, "gui": args.gui, "repeat": r}
+        for m, size, n, syntax, r in itertools.product(
+            args.modalities.split(","), args.sizes.split(","), args.slices.split(","),
+            args.syntaxes.split(","), range(args.repeat))
+    ]
+
+    results = []
+    for case in cases:
+        label = f"{case['modality']} {case['size']}x{case['size']}x{case['slices']} {case['syntax']} #{case['repeat']}"
+        print(f"running {label} ...", flush=True)
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+            result_file = f.name
+        try:
+            proc = subprocess.run([sys.executable, __file__, "--case", json.dumps(case), "--result-file", result_file])
+            if proc.returncode != 0:
+                results.append({"case": case, "error": f"exit code {proc.returncode}"})
+                continue
+            result = json.loads(Path(result_file).read_text(encoding="utf-8"))
+        finally:
+            os.unlink(result_file)
+        results.append(result)
+        if "load" in result:
+            load = result["load"]
+            print(f"  header {load['header_seconds']:.2f}s, decode {load['decode_seconds']:.2f}s, "
+                  f"total {load['total_seconds']:.2f}s, peak {result['peak_rss_mb_load']:.0f} MB")
+        elif "skipped" in result:
+            print(f"  skipped: {result['skipped']}")
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": environment(),
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"wrote {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import random
+import numpy as np
+from pathlib import Path
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import (
+    generate_uid, ExplicitVRLittleEndian, ImplicitVRLittleEndian, RLELossless,
+    JPEG2000Lossless, JPEGLSLossless, CTImageStorage, MRImageStorage,
+)
+
+# コマンドラインで指定する名前 -> 転送構文
+TRANSFER_SYNTAXES = {
+    "explicit": ExplicitVRLittleEndian,
+    "implicit": ImplicitVRLittleEndian,
+    "rle": RLELossless,
+    "j2k": JPEG2000Lossless,
+    "jpegls": JPEGLSLossless,
+}
+
+# モダリティごとの画素の設定
+MODALITIES = {
+    # CT: 12bit、Rescale Intercept -1024 でHUにする
+    "CT": {"sop_class": CTImageStorage, "bits_stored": 12, "slope": 1, "intercept": -1024,
+           "window": (40, 400), "thickness": 1.0},
+    # MR: 12bit、Rescaleなし
+    "MR": {"sop_class": MRImageStorage, "bits_stored": 12, "slope": 1, "intercept": 0,
+           "window": (600, 1200), "thickness": 3.0},
+}
+
+def phantom_slice(rows: int, cols: int, z: float, rng: np.random.Generator, max_value: int) -> np.ndarray:
+    """球とノイズからなる合成画像（圧縮率が実際の画像に近くなるよう、一様な値にはしない）"""
+    y, x = np.ogrid[-1:1:rows * 1j, -1:1:cols * 1j]
+    r2 = x * x + y * y + z * z
+    img = np.where(r2 < 0.8, 0.25, 0.0) + np.where(r2 < 0.3, 0.35, 0.0)
+    img = img * max_value + rng.normal(0, max_value * 0.01, size=(rows, cols))
+    return np.clip(img, 0, max_value).astype(np.uint16)
+
+def write_series(out_dir, modality: str = "CT", rows: int = 512, cols: int = 512, slices: int = 100,
+                 transfer_syntax: str = "explicit", shuffle: bool = True, seed: int = 0) -> list[Path]:
+    """
+    合成の系列を out_dir に書き出し、ファイルのパスを返す。
+    shuffle=True ならファイル名の順番をスライスの並びとは無関係にする（ソート処理の計測用）。
+    圧縮形式のエンコーダが無い場合は pydicom の例外をそのまま投げる
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    spec = MODALITIES[modality]
+    ts = TRANSFER_SYNTAXES[transfer_syntax]
+    rng = np.random.default_rng(seed)
+    study_uid, series_uid = generate_uid(), generate_uid()
+    max_value = (1 << spec["bits_stored"]) - 1
+
+    names = list(range(slices))
+    if shuffle:
+        random.Random(seed).shuffle(names)
+
+    paths = []
+    for i in range(slices):
+        meta = FileMetaDataset()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        meta.MediaStorageSOPClassUID = spec["sop_class"]
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SOPClassUID = spec["sop_class"]
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.Modality = modality
+        ds.PatientID = "BENCH"
+        ds.PatientName = "Bench^Synthetic"
+        ds.StudyDate = "20240101"
+        ds.SeriesDescription = f"Synthetic {modality} {rows}x{cols}x{slices}"
+        ds.SeriesNumber = 1
+        ds.InstanceNumber = i + 1
+        ds.ImagePositionPatient = [0.0, 0.0, -i * spec["thickness"]]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [0.7, 0.7]
+        ds.SliceThickness = spec["thickness"]
+        ds.RescaleSlope = spec["slope"]
+        ds.RescaleIntercept = spec["intercept"]
+        ds.WindowCenter, ds.WindowWidth = spec["window"]
+        ds.Rows, ds.Columns = rows, cols
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = spec["bits_stored"]
+        ds.HighBit = spec["bits_stored"] - 1
+        ds.PixelRepresentation = 0
+
+        arr = phantom_slice(rows, cols, 2 * i / max(slices - 1, 1) - 1, rng, max_value)
+        ds.PixelData = arr.tobytes()
+        if ts != ExplicitVRLittleEndian:
+            if ts.is_compressed:
+                ds.compress(ts, arr)
+            else:
+                ds.file_meta.TransferSyntaxUID = ts
+
+        path = out_dir / f"IM{names[i]:05d}.dcm"
+        ds.save_as(path, enforce_file_format=True)
+        paths.append(path)
+    return paths
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="合成のDICOM系列を書き出す")
+    parser.add_argument("out_dir")
+    parser.add_argument("--modality", choices=list(MODALITIES), default="CT")
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--slices", type=int, default=100)
+    parser.add_argument("--syntax", choices=list(TRANSFER_SYNTAXES), default="explicit")
+    parser.add_argument("--no-shuffle", action="store_true")
+    args = parser.parse_args()
+    write_series(args.out_dir, args.modality, args.size, args.size, args.slices, args.syntax, not args.no_shuffle)
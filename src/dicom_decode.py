@@ -0,0 +1,141 @@
+import time
+import pydicom
+import numpy as np
+from pydicom.uid import UID
+from pydicom.pixels import get_decoder, iter_pixels
+
+from modality_lut import ModalityLUT
+from profiling import instrument
+
+# 圧縮転送構文で使うデコーダの優先順（インストールされている中で最初のものを使う）
+DECODER_PREFERENCE = ["pylibjpeg", "gdcm", "pillow", "pyjpegls", "pydicom"]
+# マルチフレームを並列に展開するときの1タスクあたりのフレーム数
+FRAME_BATCH = 16
+
+# Functional Groups から引く項目（マルチフレームのフレームごとの値）
+FRAME_KEYWORDS = {
+    "ImagePositionPatient", "ImageOrientationPatient", "PixelSpacing", "SliceThickness",
+    "RescaleSlope", "RescaleIntercept", "WindowCenter", "WindowWidth", "AcquisitionTime",
+}
+
+_plugins: dict[str, str] = {}
+
+def transfer_syntax(dcm) -> UID:
+    meta = getattr(dcm, "file_meta", None)
+    return UID(meta.TransferSyntaxUID) if meta is not None and "TransferSyntaxUID" in meta else UID("")
+
+def choose_plugin(ts: UID) -> str:
+    """転送構文ごとに、インストール済みで最も速いデコーダの名前を選ぶ（非圧縮は ""）"""
+    if not ts or not ts.is_compressed:
+        return ""
+    if ts not in _plugins:
+        try:
+            available = get_decoder(ts).available_plugins
+        except NotImplementedError:
+            available = ()
+        names = [name for name in DECODER_PREFERENCE if name in available] or list(available)
+        if not names:
+            raise ValueError(f"{ts.name} を展開できるデコーダがありません（pylibjpeg / gdcm / pillow をインストールしてください）")
+        _plugins[ts] = names[0]
+    return _plugins[ts]
+
+def frame_count(dcm) -> int:
+    return int(dcm.get("NumberOfFrames", 1) or 1)
+
+class FrameHeader:
+    """
+    マルチフレームの1フレームを、単一フレームのヘッダと同じように扱うためのビュー。
+    位置・方向・Rescale などはフレームごとの Functional Group、次に共通の Functional Group、
+    最後に通常のタグの順で探す
+    """
+    def __init__(self, dataset, frame: int, per_frame=None, shared=None):
+        self.dataset = dataset
+        self.frame = frame
+        self._groups = [g for g in (per_frame, shared) if g is not None]
+
+    def _find(self, keyword):
+        if keyword in FRAME_KEYWORDS:
+            for group in self._groups:
+                for elem in group:
+                    if elem.VR != "SQ" or not elem.value: continue
+                    item = elem.value[0]
+                    if keyword in item:
+                        return item[keyword].value
+        return self.dataset.get(keyword)
+
+    def get(self, keyword, default=None):
+        value = self._find(keyword)
+        return default if value is None else value
+
+    def __contains__(self, keyword):
+        return self._find(keyword) is not None
+
+    def __getattr__(self, keyword):
+        if keyword.startswith("_"):
+            raise AttributeError(keyword)
+        value = self._find(keyword)
+        if value is None:
+            raise AttributeError(keyword)
+        return value
+
+def expand_frames(f_path, dcm) -> list:
+    """1ファイルを (パス, ヘッダ) の並びにする。マルチフレームはフレームごとに FrameHeader を作る"""
+    n = frame_count(dcm)
+    if n == 1:
+        return [(f_path, dcm)]
+    per_frame = dcm.get("PerFrameFunctionalGroupsSequence")
+    shared = dcm.get("SharedFunctionalGroupsSequence")
+    shared_item = shared[0] if shared else None
+    return [
+        (f_path, FrameHeader(dcm, i, per_frame[i] if per_frame and i < len(per_frame) else None, shared_item))
+        for i in range(n)
+    ]
+
+@instrument("decode.slice")
+def decode_slice(volume: np.ndarray, index: int, dcm, lut: ModalityLUT):
+    """単一フレームのファイルを1枚展開して volume[index] に書き込む。(書いた番号, 転送構文名, 秒) を返す"""
+    t0 = time.perf_counter()
+    ts = transfer_syntax(dcm)
+    lut.apply(pydicom.pixels.pixel_array(dcm, decoding_plugin=choose_plugin(ts)), volume[index], index)
+    # 遅延読み込みされたPixel Dataのバイト列を手放してメモリを二重に持たない
+    del dcm.PixelData
+    return [index], ts.name, time.perf_counter() - t0
+
+@instrument("decode.frames")
+def decode_frames(volume: np.ndarray, f_path, frames: list[tuple[int, int]], ts: UID, lut: ModalityLUT):
+    """
+    マルチフレームの一部 (フレーム番号, ボリューム上の番号) をまとめて展開し、直接書き込む。
+    ファイルはタスクごとに開くので、同じファイルの別のフレームを並列に展開できる
+    """
+    t0 = time.perf_counter()
+    arrays = iter_pixels(str(f_path), indices=[f for f, _ in frames], decoding_plugin=choose_plugin(ts))
+    for (_, index), arr in zip(frames, arrays):
+        lut.apply(arr, volume[index], index)
+    return [index for _, index in frames], ts.name, time.perf_counter() - t0
+
+def decode_tasks(entries: list) -> list[tuple]:
+    """
+    並べ替え済みの (パス, ヘッダ) から展開タスクを作る。
+    単一フレームは1枚ずつ、マルチフレームは同じファイルのフレームを FRAME_BATCH 枚ずつまとめる。
+    戻り値は (関数, 先頭以外の引数, 代表のボリューム番号) の並び
+    """
+    tasks = []
+    by_file = {}
+    for index, (f_path, header) in enumerate(entries):
+        if isinstance(header, FrameHeader):
+            by_file.setdefault(id(header.dataset), (f_path, header.dataset, []))[2].append((header.frame, index))
+        else:
+            tasks.append((decode_slice, (index, header), index))
+    for f_path, dataset, frames in by_file.values():
+        # 並べ替え後も、ファイル内ではフレーム順に読む方が速い
+        frames.sort()
+        ts = transfer_syntax(dataset)
+        for start in range(0, len(frames), FRAME_BATCH):
+            batch = frames[start:start + FRAME_BATCH]
+            tasks.append((decode_frames, (f_path, batch, ts), batch[len(batch) // 2][1]))
+    return tasks
+
+def read_frame(f_path, frame: int | None, plugin: str, lut: ModalityLUT, index: int) -> np.ndarray:
+    """1フレームだけを読んで展開する（遅延モード用）。frame=None は単一フレームのファイル"""
+    arr = pydicom.pixels.pixel_array(str(f_path), index=frame, decoding_plugin=plugin)
+    return lut.rescale(arr, index)
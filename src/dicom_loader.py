@@ -1,8 +1,64 @@
-import os
+import time
 import pydicom
 import numpy as np
+from pydicom.errors import InvalidDicomError
+from pydicom.tag import Tag
+from pydicom.datadict import dictionary_description, dictionary_VR
 from pathlib import Path
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from volume_cache import VolumeCache, file_signature
+from slice_geometry import geometry_from_headers
+from modality_lut import ModalityLUT, modality_lut_from_headers
+from slice_table import SliceTable
+from profiling import profiler
+from dicom_decode import FrameHeader, expand_frames, decode_tasks, read_frame, choose_plugin, transfer_syntax
+
+# ヘッダ走査時、これより大きい要素（Pixel Dataなど）は読み込みを遅延させる
+# 遅延された要素はデコード時にファイルの該当位置だけを読み直す
+DEFER_SIZE = "4 KB"
+
+# 段階読み込み時、到着したスライスをまとめて通知する間隔（秒）
+PROGRESS_INTERVAL = 0.05
+
+# スライスごとのヘッダ表を保持する枚数（超えたら古いものから捨てる）
+HEADER_CACHE_SIZE = 32
+
+@dataclass
+class LoadStats:
+    """読み込み処理の計測結果"""
+    file_count: int
+    header_seconds: float
+    decode_seconds: float
+    from_cache: bool = False
+    # 転送構文ごとの展開実績: 名前 -> [フレーム数, 展開にかかった秒数（スレッドごとの合計）]
+    decode_by_syntax: dict = field(default_factory=dict)
+    # 確保したボリュームに届いた順に書き込んだ（途中のボリュームを表示した）か。キャッシュ・遅延読み込みでは False
+    progressive: bool = False
+    # 壊れている等で読み飛ばしたファイルの数
+    skipped: int = 0
+    # ファイル一覧に含まれていた系列の数（2以上なら最もファイル数の多い系列だけを読んだ）
+    series_count: int = 1
+
+    @property
+    def syntax_summary(self) -> str:
+        """転送構文ごとの1スレッドあたりの展開速度"""
+        return ", ".join(
+            f"{name or 'Unknown'}: {frames / seconds:.0f} frames/s/thread"
+            for name, (frames, seconds) in self.decode_by_syntax.items() if seconds > 0
+        )
+
+    @property
+    def total_seconds(self) -> float:
+        return self.header_seconds + self.decode_seconds
+
+    @property
+    def files_per_second(self) -> float:
+        if self.total_seconds <= 0:
+            return 0.0
+        return self.file_count / self.total_seconds
 
 @dataclass
 class DicomSeriesData:
@@ -14,70 +70,185 @@ class DicomSeriesData:
     header_data: list[dict] 
     window_center: float
     window_width: float
+    load_stats: LoadStats | None = None
+    # ボリュームから計算した派生データ（ピラミッドなど）の置き場。系列ごとに1回だけ計算する
+    derived: dict = field(default_factory=dict, repr=False)
+    # 段階読み込みでまだスライスが届いている途中なら True
+    loading: bool = False
+    # ImagePositionPatient から求めたスライス間隔 (mm)。求められない系列は None
+    slice_spacing: float | None = None
+    # 重複スライスや不等間隔など、ジオメトリの注意事項
+    geometry_warnings: list[str] = field(default_factory=list)
+    # Modality LUT 適用後（CTならHU）に取りうる値の範囲
+    value_range: tuple[float, float] | None = None
+    # header_data の元になったファイル（シーケンスの展開時に読み直す）
+    header_path: str | None = None
+    # スライスごとの位置・InstanceNumber・Rescale・Window などの表（並べ替え後の順）
+    slices: SliceTable | None = None
+
+    @property
+    def voxel_spacing(self) -> list[float]:
+        """(z, y, x) のボクセル間隔。z はスライス厚ではなく実際の間隔を優先する"""
+        z = self.slice_spacing if self.slice_spacing else self.slice_thickness
+        return [z, self.pixel_spacing[0], self.pixel_spacing[1]]
+
+@dataclass
+class LoadProgress:
+    """段階読み込みの途中経過"""
+    data: DicomSeriesData
+    loaded: int
+    total: int
+    # 今回新たにデコードが終わったスライス番号
+    indices: list[int]
+
+# ヘッダ表に出す値の最大文字数（文字列化する前に切り詰める）
+HEADER_VALUE_CHARS = 50
+# 多値要素で表示する値の個数
+HEADER_MAX_VALUES = 8
+# この長さ (bytes) を超える要素は値を読まずにサイズだけ表示する
+HEADER_MAX_BYTES = 1024
+# 値を文字列にしないバイナリのVR
+BINARY_VRS = {"OB", "OW", "OF", "OD", "OL", "OV", "UN"}
+
+def _tag_name(tag: Tag) -> str:
+    try:
+        return dictionary_description(tag)
+    except KeyError:
+        return "Private Tag" if tag.is_private else "Unknown Tag"
 
-def format_dicom_header(dcm: pydicom.dataset.FileDataset) -> list[dict]:
+def _tag_vr(raw) -> str:
+    if raw.VR:
+        return raw.VR
+    try:
+        return dictionary_VR(raw.tag)
+    except KeyError:
+        return "UN"
+
+def _format_value(value) -> str:
+    """値を表示用の文字列にする。長い値は文字列にする前に切り詰める"""
+    if isinstance(value, (str, bytes)):
+        text = str(value[:HEADER_VALUE_CHARS + 1])
+    elif isinstance(value, (list, pydicom.multival.MultiValue)):
+        text = "\\".join(str(v) for v in value[:HEADER_MAX_VALUES])
+        if len(value) > HEADER_MAX_VALUES:
+            text += f"\\... ({len(value)} values)"
+    else:
+        text = str(value)
+    if len(text) > HEADER_VALUE_CHARS:
+        text = text[:HEADER_VALUE_CHARS] + "..."
+    return text
+
+def format_dicom_header(dcm: pydicom.dataset.Dataset, path: list | None = None, depth: int = 0) -> list[dict]:
     """
     DICOMデータセットから主要なタグを抽出し、
-    UIのテーブルで表示しやすい辞書のリスト形式に正規化する純粋関数
+    UIのテーブルで表示しやすい辞書のリスト形式に正規化する純粋関数。
+    大きな要素・バイナリ・シーケンスは値を読まず（文字列化もせず）に要約だけを返す。
+    シーケンスの行には展開用の "Path" を付ける（expand_header_rows で中身を取得）
     """
     header_rows = []
-    
-    # 階層を持たずフラットに全タグを走査
-    for elem in dcm:
+    path = path or []
+
+    # 未変換の要素のまま走査し、必要なものだけ値を取り出す
+    for raw in dcm.elements():
+        tag = Tag(raw.tag)
         # Pixel DataやOverlay Dataなど、巨大なバイナリデータは表示から除外
-        if elem.tag.group in (0x7FE0, 0x6000, 0x6002):
+        if tag.group in (0x7FE0, 0x6000, 0x6002):
             continue
-        
-        # 値の整形（長い文字列は切り詰めるなどの処理）
-        val_str = str(elem.value)
-        if len(val_str) > 50:
-            val_str = val_str[:50] + "..."
-            
-        header_rows.append({
-            "Tag": f"{elem.tag}",       # (0010, 0010) のような形式
-            "Name": elem.name,          # "Patient's Name" など
-            "VR": elem.VR,              # Value Representation (PN, UI, CSなど)
-            "Value": val_str            # 実際の値
-        })
-        
+
+        vr = _tag_vr(raw)
+        length = getattr(raw, "length", None)
+        row = {
+            "Tag": f"{tag}",            # (0010, 0010) のような形式
+            "Name": _tag_name(tag),     # "Patient's Name" など
+            "VR": vr,                   # Value Representation (PN, UI, CSなど)
+            "Depth": depth
+        }
+        if vr == "SQ":
+            row["Value"] = "<Sequence>"
+            row["Path"] = path + [int(tag)]
+        elif vr in BINARY_VRS or (length is not None and length > HEADER_MAX_BYTES):
+            row["Value"] = f"<{vr}, {length} bytes>" if length is not None else f"<{vr}>"
+        else:
+            row["Value"] = _format_value(dcm[tag].value)
+        header_rows.append(row)
+
     return header_rows
 
-def load_dicom_series(folder_path: str) -> DicomSeriesData:
-    path = Path(folder_path)
-    if not path.is_dir():
-        raise ValueError("フォルダが見つかりません")
+def expand_header_rows(header_path: str, path: list, depth: int) -> list[dict]:
+    """
+    シーケンス行を展開する。header_path のファイルからヘッダを読み直し、
+    path（タグ, アイテム番号, タグ, ... の並び）の指すシーケンスの各アイテムを整形する
+    """
+    ds = pydicom.dcmread(header_path, stop_before_pixels=True, defer_size=DEFER_SIZE)
+    for i, key in enumerate(path):
+        ds = ds[key] if i % 2 == 0 else ds.value[key]
+    rows = []
+    for i, item in enumerate(ds.value):
+        rows.append({"Tag": "", "Name": f"Item #{i + 1}", "VR": "", "Value": "", "Depth": depth})
+        rows.extend(format_dicom_header(item, path + [i], depth + 1))
+    return rows
 
-    dicom_files = []
-    for f in path.glob("*"):
-        if f.is_file():
-            try:
-                dcm = pydicom.dcmread(f, stop_before_pixels=True)
-                dicom_files.append((f, dcm))
-            except:
-                continue
-    
-    if not dicom_files:
-        raise ValueError("DICOMファイルが見つかりません")
+def slice_header_rows(data, index: int) -> list[dict]:
+    """
+    index 枚目のスライスのヘッダ表。必要になった時にそのファイルのヘッダだけを読み、
+    直近 HEADER_CACHE_SIZE 枚分を data.derived に保持する
+    """
+    if data.slices is None:
+        return data.header_data
+    path = data.slices.paths[index]
+    if path == data.header_path:
+        return data.header_data
+    cache = data.derived.setdefault("headers", OrderedDict())
+    if path in cache:
+        cache.move_to_end(path)
+        return cache[path]
+    ds = pydicom.dcmread(path, stop_before_pixels=True, defer_size=DEFER_SIZE)
+    rows = cache[path] = format_dicom_header(ds)
+    while len(cache) > HEADER_CACHE_SIZE:
+        cache.popitem(last=False)
+    return rows
 
-    # ソート
-    dicom_files.sort(key=lambda x: x[1].InstanceNumber if 'InstanceNumber' in x[1] else x[0].name)
+# 読めなかったファイルを表す _read_header の戻り値（DICOMでないファイルの None と区別して数える）
+_SKIPPED = object()
 
-    # 最初のファイルのヘッダ情報を代表として取得・整形
-    first_dcm_header = pydicom.dcmread(dicom_files[0][0]) # ピクセルごと全部読む必要はないが、ヘッダ解析用に1つ読む
-    formatted_header = format_dicom_header(first_dcm_header)
+def _read_header(f_path: Path):
+    """ピクセルデータを遅延させてヘッダだけを解析する。DICOMでなければNone、壊れていれば _SKIPPED"""
+    try:
+        dcm = pydicom.dcmread(f_path, defer_size=DEFER_SIZE)
+    except InvalidDicomError:
+        return None
+    except Exception:
+        # 壊れたファイル等は読み飛ばし、件数だけを LoadStats に残す（ファイルごとには出力しない）
+        return _SKIPPED
+    if "PixelData" not in dcm:
+        return None
+    return dcm
+
+def _has_dask() -> bool:
+    try:
+        import dask.array  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def _lazy_volume(entries: list, shape: tuple[int, int], lut: ModalityLUT):
+    """フレームごとのデコードを遅延タスクにした (z, y, x) のdask配列を作る"""
+    import dask
+    import dask.array as da
 
-    # 全ボリュームデータの読み込み
     slices = []
-    first_dcm = None # メタデータ取得用
-    
-    for f_path, _ in dicom_files:
-        dcm = pydicom.dcmread(f_path)
-        if first_dcm is None:
-            first_dcm = dcm
-        slices.append(dcm.pixel_array)
+    for i, (f, header) in enumerate(entries):
+        frame = header.frame if isinstance(header, FrameHeader) else None
+        plugin = choose_plugin(transfer_syntax(_dataset_of(header)))
+        slices.append(da.from_delayed(dask.delayed(read_frame)(f, frame, plugin, lut, i), shape=shape, dtype=lut.dtype))
+    return da.stack(slices)
 
-    volume = np.array(slices)
-    
+def _dataset_of(header):
+    """FrameHeader なら元のマルチフレームのデータセット"""
+    return header.dataset if isinstance(header, FrameHeader) else header
+
+def _make_series_data(volume: np.ndarray, first_dcm, header_data: list[dict], geometry=None,
+                      lut: ModalityLUT | None = None) -> DicomSeriesData:
     spacing = getattr(first_dcm, 'PixelSpacing', [1.0, 1.0])
     thickness = getattr(first_dcm, 'SliceThickness', 1.0)
     desc = getattr(first_dcm, 'SeriesDescription', "No Description")
@@ -92,7 +263,165 @@ def load_dicom_series(folder_path: str) -> DicomSeriesData:
         pixel_spacing=[float(x) for x in spacing],
         slice_thickness=float(thickness),
         series_description=str(desc),
-        header_data=formatted_header, # ここを変更
+        header_data=header_data, # ここを変更
         window_center=float(wc),
-        window_width=float(ww)
-    )
\ No newline at end of file
+        window_width=float(ww),
+        slice_spacing=geometry.spacing if geometry else None,
+        geometry_warnings=geometry.warnings if geometry else [],
+        value_range=lut.value_range if lut else None,
+        header_path=str(_dataset_of(first_dcm).filename) if _dataset_of(first_dcm).filename else None
+    )
+
+def iter_load_dicom_series(folder_path: str, max_workers: int | None = None,
+                           cache: VolumeCache | None = None, lazy: bool = False):
+    """
+    系列を段階的に読み込むジェネレータ。
+    ヘッダ解析が終わった時点で空のボリュームを持つ LoadProgress を1回返し、
+    以降はデコード済みのスライスが届くたびに LoadProgress を返す。
+    途中で close() されると未着手のデコードは破棄される。
+    cache を渡すと、同じファイル群を以前読んでいればヘッダも読まずにキャッシュから開く。
+    lazy=True かつ dask が使える場合は、ピクセルを読まずに遅延評価のdask配列を返す
+    （RAMに収まらない系列向け。キャッシュには保存しない）
+    """
+    path = Path(folder_path)
+    if not path.is_dir():
+        raise ValueError("フォルダが見つかりません")
+
+    files = [f for f in path.glob("*") if f.is_file()]
+    return (yield from iter_load_dicom_files(files, max_workers, cache, lazy))
+
+def iter_load_dicom_files(files: list[Path], max_workers: int | None = None,
+                          cache: VolumeCache | None = None, lazy: bool = False):
+    """
+    ファイルの一覧から1系列を読み込む（iter_load_dicom_series と同じ LoadProgress を返す）。
+    複数の系列が混ざっている場合は、最もファイル数の多い系列だけを使う
+    """
+    files = [Path(f) for f in files]
+    signature = None
+    if cache is not None and cache.enabled and not lazy:
+        t0 = time.perf_counter()
+        signature = file_signature(files)
+        key = cache.lookup(signature)
+        cached = cache.load(key) if key else None
+        if cached is not None:
+            volume, fields = cached
+            data = DicomSeriesData(volume=volume, **fields)
+            total = volume.shape[0]
+            data.load_stats = LoadStats(file_count=total, header_seconds=time.perf_counter() - t0, decode_seconds=0.0,
+                                       from_cache=True)
+            yield LoadProgress(data=data, loaded=total, total=total, indices=list(range(total)))
+            return data
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        # 1パス目: 全ファイルのヘッダを並列に1回だけ解析
+        t0 = time.perf_counter()
+        headers = list(pool.map(_read_header, files))
+        skipped = sum(dcm is _SKIPPED for dcm in headers)
+        dicom_files = [
+            (f, dcm) for f, dcm in zip(files, headers)
+            if dcm is not None and dcm is not _SKIPPED
+        ]
+        if not dicom_files:
+            raise ValueError("DICOMファイルが見つかりません" + (f"（読めないファイル {skipped} 件）" if skipped else ""))
+
+        # 系列が混ざっていたら1つに絞る（別系列のスライスを同じボリュームに積まない）
+        by_series = {}
+        for f, dcm in dicom_files:
+            by_series.setdefault(str(dcm.get("SeriesInstanceUID", "")), []).append((f, dcm))
+        series_count = len(by_series)
+        if series_count > 1:
+            dicom_files = max(by_series.values(), key=len)
+
+        # 展開できない圧縮形式はデコードを始める前に知らせる
+        for ts in {transfer_syntax(dcm) for _, dcm in dicom_files}:
+            choose_plugin(ts)
+        # マルチフレーム（Enhanced CT/MRなど）はフレームを1枚ずつのスライスとして並べる
+        dicom_files = [entry for f, dcm in dicom_files for entry in expand_frames(f, dcm)]
+
+        # ソート: 位置・方向が取れれば法線への射影で、取れなければ InstanceNumber（無ければファイル名）で
+        geometry = geometry_from_headers([dcm for _, dcm in dicom_files])
+        if geometry is not None:
+            dicom_files = [dicom_files[i] for i in geometry.order]
+        else:
+            dicom_files.sort(key=lambda x: x[1].InstanceNumber if 'InstanceNumber' in x[1] else x[0].name)
+        first_dcm = dicom_files[0][1]
+
+        # 最初のファイルのヘッダ情報を代表として整形（再読み込みはしない）
+        formatted_header = format_dicom_header(_dataset_of(first_dcm))
+        # ヘッダの解析結果はここで小さな表にまとめ、各スライスのヘッダ全体は持たない
+        slices = SliceTable.from_headers([f for f, _ in dicom_files], [dcm for _, dcm in dicom_files])
+
+        rows, cols = int(first_dcm.Rows), int(first_dcm.Columns)
+        for f_path, dcm in dicom_files:
+            if (int(dcm.Rows), int(dcm.Columns)) != (rows, cols):
+                raise ValueError(f"画像サイズが一致しません: {f_path.name}")
+        # RescaleSlope / Intercept はスライスごとに持ち、デコード時にその場で掛ける
+        lut = modality_lut_from_headers([dcm for _, dcm in dicom_files])
+        t1 = time.perf_counter()
+        profiler.record("load.headers", t1 - t0, t0)
+
+        total = len(dicom_files)
+        if lazy and _has_dask():
+            # 遅延モード: 1スライス1チャンクのdask配列を返し、表示に必要なスライスだけデコードする
+            volume = _lazy_volume(dicom_files, (rows, cols), lut)
+            data = _make_series_data(volume, first_dcm, formatted_header, geometry, lut)
+            data.slices = slices
+            data.load_stats = LoadStats(file_count=total, header_seconds=t1 - t0, decode_seconds=0.0,
+                                        skipped=skipped, series_count=series_count)
+            yield LoadProgress(data=data, loaded=total, total=total, indices=list(range(total)))
+            return data
+
+        # (z, y, x) を先に確保する。未到着のスライスは0（黒）のまま表示される
+        volume = np.zeros((total, rows, cols), dtype=lut.dtype)
+        data = _make_series_data(volume, first_dcm, formatted_header, geometry, lut)
+        data.slices = slices
+        data.loading = True
+        yield LoadProgress(data=data, loaded=0, total=total, indices=[])
+
+        # 2パス目: 初期表示位置（中央）に近いスライスから並列にデコード
+        # （マルチフレームは同じファイルのフレームをまとめたタスクになる）
+        tasks = sorted(decode_tasks(dicom_files), key=lambda t: abs(t[2] - total // 2))
+        pending = {pool.submit(func, volume, *args, lut) for func, args, _ in tasks}
+        by_syntax = {}
+        loaded = 0
+        while pending:
+            done, pending = wait(pending, timeout=PROGRESS_INTERVAL)
+            indices = []
+            for fut in done:
+                written, syntax, seconds = fut.result()
+                indices.extend(written)
+                stat = by_syntax.setdefault(syntax, [0, 0.0])
+                stat[0] += len(written)
+                stat[1] += seconds
+            if indices:
+                loaded += len(indices)
+                yield LoadProgress(data=data, loaded=loaded, total=total, indices=sorted(indices))
+        t2 = time.perf_counter()
+        profiler.record("load.decode", t2 - t1, t1)
+
+        data.load_stats = LoadStats(file_count=total, header_seconds=t1 - t0, decode_seconds=t2 - t1,
+                                    decode_by_syntax=by_syntax, progressive=True, skipped=skipped,
+                                    series_count=series_count)
+        data.loading = False
+
+        if signature is not None:
+            series_uid = str(getattr(first_dcm, "SeriesInstanceUID", ""))
+            cache.store(cache.make_key(series_uid, signature), signature, data, series_uid)
+        return data
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def load_dicom_files(files: list[Path], max_workers: int | None = None,
+                     cache: VolumeCache | None = None, lazy: bool = False) -> DicomSeriesData:
+    progress = None
+    for progress in iter_load_dicom_files(files, max_workers, cache, lazy):
+        pass
+    return progress.data
+
+def load_dicom_series(folder_path: str, max_workers: int | None = None,
+                      cache: VolumeCache | None = None, lazy: bool = False) -> DicomSeriesData:
+    progress = None
+    for progress in iter_load_dicom_series(folder_path, max_workers, cache, lazy):
+        pass
+    return progress.data
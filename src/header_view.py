@@ -0,0 +1,136 @@
+from qtpy.QtCore import Qt, QAbstractTableModel, QModelIndex, QSortFilterProxyModel
+from qtpy.QtWidgets import QWidget, QVBoxLayout, QLineEdit, QTableView, QHeaderView, QAbstractItemView
+
+# 表示する列（format_dicom_header の行のキー）
+COLUMNS = ["Tag", "Name", "VR", "Value"]
+# 1行の高さ (px)。固定にしておくと行数に関係なく高さ計算が要らない
+ROW_HEIGHT = 20
+
+class HeaderModel(QAbstractTableModel):
+    """
+    format_dicom_header の行をそのまま持つモデル。
+    文字列はビューが描画する行の分だけ data() で取り出される
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows: list[dict] = []
+        # 展開中のシーケンス行（id）
+        self._expanded: set[int] = set()
+
+    def set_rows(self, rows: list[dict]):
+        self.beginResetModel()
+        self.rows = list(rows)
+        self._expanded.clear()
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid(): return None
+        row = self.rows[index.row()]
+        column = COLUMNS[index.column()]
+        if role == Qt.DisplayRole:
+            text = row.get(column, "")
+            if column == "Name":
+                # ネストの深さはインデントで表す。展開できる行には印を付ける
+                mark = ""
+                if "Path" in row:
+                    mark = "- " if id(row) in self._expanded else "+ "
+                text = "    " * row.get("Depth", 0) + mark + text
+            return text
+        if role == Qt.ToolTipRole and column == "Value":
+            return row.get("Value", "")
+        return None
+
+    def toggle(self, row_idx: int, expand_func):
+        """シーケンス行を展開・折りたたむ。展開時の子の行は expand_func(row) で取得する"""
+        row = self.rows[row_idx]
+        if "Path" not in row: return
+        if id(row) in self._expanded:
+            count = self._collapse_count(row_idx)
+            self.beginRemoveRows(QModelIndex(), row_idx + 1, row_idx + count)
+            removed = self.rows[row_idx + 1:row_idx + 1 + count]
+            del self.rows[row_idx + 1:row_idx + 1 + count]
+            for child in removed:
+                self._expanded.discard(id(child))
+            self._expanded.discard(id(row))
+            self.endRemoveRows()
+        else:
+            children = expand_func(row)
+            if not children: return
+            self.beginInsertRows(QModelIndex(), row_idx + 1, row_idx + len(children))
+            self.rows[row_idx + 1:row_idx + 1] = children
+            self._expanded.add(id(row))
+            self.endInsertRows()
+        # 記号（+ / -）の表示を更新
+        name_index = self.index(row_idx, COLUMNS.index("Name"))
+        self.dataChanged.emit(name_index, name_index)
+
+    def _collapse_count(self, row_idx: int) -> int:
+        """row_idx の下に表示されている子孫の行数（より深い行が続く範囲）"""
+        depth = self.rows[row_idx].get("Depth", 0)
+        end = row_idx + 1
+        while end < len(self.rows) and self.rows[end].get("Depth", 0) > depth:
+            end += 1
+        return end - row_idx - 1
+
+class HeaderView(QWidget):
+    """
+    フィルタ欄つきのDICOMヘッダ表。QTableView は見えている行しか描画しないので、
+    タグの数が多くても表示のコストは増えない。シーケンス行はダブルクリックで展開する
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.model = HeaderModel(self)
+        self.proxy = QSortFilterProxyModel(self)
+        self.proxy.setSourceModel(self.model)
+        self.proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        # Tag / Name / VR / Value のどれかに一致すれば表示
+        self.proxy.setFilterKeyColumn(-1)
+        # シーケンスの展開関数 (row -> 子の行)。系列ごとに set_rows で受け取る
+        self.expand_func = None
+
+        self.filter_edit = QLineEdit(self)
+        self.filter_edit.setPlaceholderText("Filter tags (e.g. 0028 or Spacing)")
+        self.filter_edit.setClearButtonEnabled(True)
+        self.filter_edit.textChanged.connect(self.proxy.setFilterFixedString)
+
+        self.table = QTableView(self)
+        self.table.setModel(self.proxy)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setWordWrap(False)
+        self.table.verticalHeader().setVisible(False)
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(ROW_HEIGHT)
+        # 内容に合わせた列幅の計算は全行を走査するので使わない
+        header = self.table.horizontalHeader()
+        header.setSectionResizeMode(QHeaderView.Interactive)
+        header.setStretchLastSection(True)
+        self.table.setColumnWidth(0, 90)
+        self.table.setColumnWidth(1, 180)
+        self.table.setColumnWidth(2, 40)
+        self.table.doubleClicked.connect(self._on_double_clicked)
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.filter_edit)
+        layout.addWidget(self.table)
+
+    def set_rows(self, rows: list[dict], expand_func=None):
+        self.expand_func = expand_func
+        self.model.set_rows(rows)
+
+    def _on_double_clicked(self, index):
+        if self.expand_func is None: return
+        row_idx = self.proxy.mapToSource(index).row()
+        self.model.toggle(row_idx, self.expand_func)
@@ -0,0 +1,66 @@
+import napari
+from contextlib import contextmanager
+
+class LayerPool:
+    """
+    モード（コントローラ）ごとのレイヤーを保持する。
+    モード切替ではレイヤーを破棄せず表示/非表示だけを切り替えるので、
+    GPUへのボリューム再転送やレイアウト計算をやり直さずに済む
+    """
+    def __init__(self, viewer: napari.Viewer):
+        self.viewer = viewer
+        # owner -> その owner が作ったレイヤー
+        self._layers: dict[object, list] = {}
+        # 非表示にする直前の visible（ユーザーがチェックボックス等で切り替えた状態を戻すため）
+        self._visible: dict[int, bool] = {}
+        # False にすると、非表示にしたモードのレイヤーをその場で解放する（メモリ節約）
+        self.keep_hidden = True
+
+    @contextmanager
+    def collect(self, owner):
+        """ブロック内で viewer に追加されたレイヤーを owner のものとして登録する"""
+        added = []
+        def on_inserted(event):
+            added.append(event.value)
+        self.viewer.layers.events.inserted.connect(on_inserted)
+        try:
+            yield
+        finally:
+            self.viewer.layers.events.inserted.disconnect(on_inserted)
+            self._layers.setdefault(owner, []).extend(added)
+
+    def has(self, owner) -> bool:
+        """owner のレイヤーが揃って残っているか（ユーザーが削除していないか）"""
+        layers = self._layers.get(owner)
+        if not layers: return False
+        return all(layer in self.viewer.layers for layer in layers)
+
+    def show(self, owner):
+        for layer in self._layers.get(owner, []):
+            layer.visible = self._visible.pop(id(layer), True)
+
+    def hide(self, owner):
+        if not self.keep_hidden:
+            self.release(owner)
+            return
+        for layer in self._layers.get(owner, []):
+            if id(layer) not in self._visible:
+                self._visible[id(layer)] = layer.visible
+            layer.visible = False
+
+    def release(self, owner):
+        """owner のレイヤーを viewer から取り除いて破棄する"""
+        for layer in self._layers.pop(owner, []):
+            self._visible.pop(id(layer), None)
+            if layer in self.viewer.layers:
+                self.viewer.layers.remove(layer)
+
+    def release_hidden(self, active_owner):
+        """表示中のモード以外のレイヤーをすべて解放する"""
+        for owner in list(self._layers):
+            if owner is not active_owner:
+                self.release(owner)
+
+    def release_all(self):
+        for owner in list(self._layers):
+            self.release(owner)
@@ -0,0 +1,63 @@
+import numpy as np
+from dataclasses import dataclass
+
+# 整数のまま表せる場合に試す型（小さい順）
+INTEGER_DTYPES = [np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32]
+
+@dataclass
+class ModalityLUT:
+    """スライスごとの RescaleSlope / RescaleIntercept と、変換後の値を正確に保持できる型"""
+    slopes: np.ndarray
+    intercepts: np.ndarray
+    dtype: np.dtype
+    # 変換後に取りうる値の範囲（BitsStored から求めた理論値）
+    value_range: tuple[float, float]
+
+    def apply(self, raw: np.ndarray, out: np.ndarray, index: int) -> None:
+        """index 枚目の生の画素値を out へ書き込み、その場で slope / intercept を掛ける"""
+        out[...] = raw
+        slope, intercept = self.slopes[index], self.intercepts[index]
+        if np.issubdtype(self.dtype, np.integer):
+            slope, intercept = int(slope), int(intercept)
+        if slope != 1:
+            out *= slope
+        if intercept != 0:
+            out += intercept
+
+    def rescale(self, raw: np.ndarray, index: int) -> np.ndarray:
+        out = np.empty(raw.shape, dtype=self.dtype)
+        self.apply(raw, out, index)
+        return out
+
+def _stored_range(dcm) -> tuple[int, int]:
+    """BitsStored / PixelRepresentation から生の画素値の範囲を求める"""
+    bits = int(dcm.get("BitsStored", dcm.get("BitsAllocated", 16)))
+    if int(dcm.get("PixelRepresentation", 0)) == 1:
+        return -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+    return 0, (1 << bits) - 1
+
+def modality_lut_from_headers(headers: list) -> ModalityLUT:
+    """
+    全スライスの slope / intercept を配列にまとめ、変換途中も含めて値が収まる最小の型を選ぶ。
+    slope / intercept がすべて整数なら整数型（CTならほぼ int16）、そうでなければ float32
+    """
+    slopes = np.array([float(dcm.get("RescaleSlope", 1) or 1) for dcm in headers])
+    intercepts = np.array([float(dcm.get("RescaleIntercept", 0) or 0) for dcm in headers])
+    lo, hi = _stored_range(headers[0])
+
+    scaled = np.stack([slopes * lo, slopes * hi])
+    final = scaled + intercepts
+    value_range = (float(final.min()), float(final.max()))
+
+    integral = np.all(slopes == np.round(slopes)) and np.all(intercepts == np.round(intercepts))
+    dtype = np.dtype(np.float32)
+    if integral:
+        # 生の値・slope を掛けた値・最終値のすべてが入る型（途中で桁あふれしないように）
+        need_lo = min(lo, scaled.min(), final.min())
+        need_hi = max(hi, scaled.max(), final.max())
+        for candidate in INTEGER_DTYPES:
+            info = np.iinfo(candidate)
+            if info.min <= need_lo and need_hi <= info.max:
+                dtype = np.dtype(candidate)
+                break
+    return ModalityLUT(slopes, intercepts, dtype, value_range)
@@ -1,6 +1,15 @@
+import time
 import napari
 import numpy as np
-from magicgui.widgets import Container, Label, PushButton, CheckBox, IntSlider
+from magicgui.widgets import Container, Label, PushButton, CheckBox, IntSlider, ComboBox, FloatSlider
+
+from layer_pool import LayerPool
+from reslice_cache import get_reslice_cache
+from prefetch import get_prefetcher
+from slab import SLAB_MODES, get_slab_index, slab_range
+from roi_stats import shape_stats
+from update_scheduler import scheduler
+from profiling import instrument, timed
 
 # 色定数
 COLOR_AXIAL = 'blue'
@@ -8,15 +17,44 @@ COLOR_CORONAL = 'green'
 COLOR_SAGITTAL = 'red'
 COLOR_TEXT = 'yellow' # ラベルの色
 
+# スライス送りのキー: キー -> 移動枚数
+SLICE_KEYS = {"Up": -1, "Down": 1, "PageUp": -10, "PageDown": 10}
+# Ctrl+ホイールでのズーム倍率（1ノッチあたり）
+WHEEL_ZOOM = 1.1
+
+# 統計を出せるROIの図形（napariのShapesの種類）
+ROI_SHAPES = ("rectangle", "ellipse", "polygon")
+COLOR_ROI = 'yellow'
+
+# クロスヘア: レイヤー名 -> (ビューの行方向の軸, 列方向の軸, [縦線の色, 横線の色])
+CROSSHAIRS = {
+    "Crosshair Axial": (1, 2, [COLOR_SAGITTAL, COLOR_CORONAL]),
+    "Crosshair Coronal": (0, 2, [COLOR_SAGITTAL, COLOR_AXIAL]),
+    "Crosshair Sagittal": (0, 1, [COLOR_CORONAL, COLOR_AXIAL]),
+}
+
 class Slice2DController:
-    def __init__(self, viewer: napari.Viewer):
+    def __init__(self, viewer: napari.Viewer, pool: LayerPool, on_slice_changed=None):
         self.viewer = viewer
+        # Axialのスライス位置が変わったら呼ばれる (z) -> None（ヘッダ表の追従など）
+        self.on_slice_changed = on_slice_changed
+        # モード切替をまたいでレイヤーを保持する
+        self.pool = pool
         self.data = None
         
         # 現在のスライス位置 [z, y, x]
         self.current_pos = [0, 0, 0]
         # 現在メインで表示している軸 (0:Axial, 1:Coronal, 2:Sagittal)
         self.main_axis = 0 
+        # 各ビューに今表示しているスライス番号（変わったビューだけ差し替える。Noneは要更新）
+        self.shown_pos = [None, None, None]
+        # クロスヘア2本分の (始点, 方向) を書き換えて使い回すバッファ。
+        # Vectors レイヤーはデータをコピーせずに持つので、レイヤーごとに別のバッファにする
+        self._crosshair_vectors = {name: np.zeros((2, 2, 2)) for name in CROSSHAIRS}
+        # 主軸ごとの直近のスライダ1ティックあたりの処理時間 (ms)
+        self.tick_ms = [0.0, 0.0, 0.0]
+        # ホイールをスライス送りに使う間、退避しておくカメラの mouse_zoom（None は未退避）
+        self._saved_mouse_zoom = None
         
         # --- UI Components ---
         self.btn_axial = PushButton(text="Main: Axial (Z)")
@@ -33,19 +71,35 @@ class Slice2DController:
 
         # スライス移動スライダ
         self.slider_slice = IntSlider(label="Slice Index")
-        self.slider_slice.changed.connect(self._on_slider_change)
+        # ドラッグ中の連続した changed は1フレームに1回へまとめる
+        self.slider_slice.changed.connect(scheduler.coalesced(self._on_slider_change))
         
         self.row_slider, self.lbl_slice_text = self._create_slider_row(self.slider_slice)
 
         self.chk_crosshair = CheckBox(value=True, label="Show Crosshairs")
         self.chk_crosshair.changed.connect(self._update_crosshairs)
 
+        # 厚みのある投影（Off で通常の1枚の断面）
+        self.combo_slab = ComboBox(choices=["Off"] + list(SLAB_MODES), value="Off", label="Slab")
+        self.slider_slab_mm = FloatSlider(value=10.0, min=1.0, max=50.0, step=0.5, label="Slab (mm)")
+        self.combo_slab.changed.connect(self._on_slab_change)
+        self.slider_slab_mm.changed.connect(scheduler.coalesced(self._on_slab_change))
+
+        self.lbl_latency = Label(value="")
+        # ROI: メインビュー上の図形（選択中、無ければ最後の図形）の統計
+        self.lbl_roi = Label(value="")
+
         self.widget = Container(
             widgets=[
                 Label(value="--- 2D Multi-View ---"),
                 Container(widgets=[self.btn_axial, self.btn_sagittal, self.btn_coronal], layout="vertical", labels=False),
                 self.row_slider,
-                self.chk_crosshair
+                self.chk_crosshair,
+                self.combo_slab,
+                self.slider_slab_mm,
+                Label(value="--- ROI ---"),
+                self.lbl_roi,
+                self.lbl_latency
             ],
             visible=False
         )
@@ -64,30 +118,72 @@ class Slice2DController:
 
     def set_data(self, data):
         self.data = data
+        # 前の系列のレイヤーは捨て、次の activate で作り直す
+        self.pool.release(self)
         if self.data:
             z, y, x = data.volume.shape
             self.current_pos = [z//2, y//2, x//2]
 
-        if self.widget.visible:
-            self._update_slider_range()
-            self._refresh_all()
-
     def activate(self):
         self.widget.visible = True
         self.viewer.dims.ndisplay = 2
-        self._setup_layers()
+        self._bind_navigation()
+        if self.pool.has(self):
+            # 保持していたレイヤーを再表示するだけ（位置や主軸はそのまま）
+            # 隠れている間に読み込みが進んだ場合に備えて、表示中の3断面だけ取り直す
+            self.pool.show(self)
+            self.shown_pos = [None, None, None]
+            self._refresh_all()
+            self.viewer.reset_view()
+            return
+        with self.pool.collect(self):
+            self._setup_layers()
         self._set_main_axis(0) 
 
     def deactivate(self):
         self.widget.visible = False
+        self._unbind_navigation()
+        self.pool.hide(self)
+
+    def _bind_navigation(self):
+        """ホイールと矢印キーでメインビューのスライスを送る（ズームは Ctrl+ホイール）"""
+        if self._saved_mouse_zoom is None:
+            self._saved_mouse_zoom = self.viewer.camera.mouse_zoom
+        self.viewer.camera.mouse_zoom = False
+        if self._on_wheel not in self.viewer.mouse_wheel_callbacks:
+            self.viewer.mouse_wheel_callbacks.append(self._on_wheel)
+        for key, step in SLICE_KEYS.items():
+            self.viewer.bind_key(key, lambda viewer, step=step: self.step_slice(step), overwrite=True)
+
+    def _unbind_navigation(self):
+        # 有効・無効を決め打ちせず、bind した時点の値に戻す
+        if self._saved_mouse_zoom is not None:
+            self.viewer.camera.mouse_zoom = self._saved_mouse_zoom
+            self._saved_mouse_zoom = None
+        if self._on_wheel in self.viewer.mouse_wheel_callbacks:
+            self.viewer.mouse_wheel_callbacks.remove(self._on_wheel)
+        for key in SLICE_KEYS:
+            self.viewer.bind_key(key, None)
+
+    def _on_wheel(self, viewer, event):
+        delta = event.delta[1]
+        if delta == 0: return
+        if "Control" in event.modifiers:
+            viewer.camera.zoom *= WHEEL_ZOOM if delta > 0 else 1 / WHEEL_ZOOM
+            return
+        # 上に回すと前のスライスへ
+        self.step_slice(-1 if delta > 0 else 1)
+
+    def step_slice(self, step: int):
+        """メインビューのスライスを step 枚動かす（スライダ経由なので更新は1フレームにまとまる）"""
+        if not self.data: return
+        self.slider_slice.value = int(np.clip(self.slider_slice.value + step, 0, self.slider_slice.max))
 
     def _setup_layers(self):
         if not self.data: return
-        self.viewer.layers.clear()
+        self.shown_pos = [None, None, None]
         
-        sp_z = self.data.slice_thickness
-        sp_y = self.data.pixel_spacing[0]
-        sp_x = self.data.pixel_spacing[1]
+        sp_z, sp_y, sp_x = self.data.voxel_spacing
 
         # 3つのImageレイヤー
         self.viewer.add_image(
@@ -104,9 +200,23 @@ class Slice2DController:
         )
 
         # クロスヘアレイヤー
-        self.viewer.add_shapes(name="Crosshair Axial", edge_width=2, face_color=[0,0,0,0], ndim=2)
-        self.viewer.add_shapes(name="Crosshair Coronal", edge_width=2, face_color=[0,0,0,0], ndim=2)
-        self.viewer.add_shapes(name="Crosshair Sagittal", edge_width=2, face_color=[0,0,0,0], ndim=2)
+        # Shapesは線を差し替えるたびにメッシュの三角形分割をやり直すので、
+        # 2本の線分を (始点, 方向) で持つVectorsレイヤーにして座標だけを書き換える
+        for name, (_, _, colors) in CROSSHAIRS.items():
+            self.viewer.add_vectors(
+                np.zeros((2, 2, 2)), name=name, edge_width=2, edge_color=colors,
+                vector_style="line", length=1
+            )
+
+        # ROI（メインビューの画素座標で持つ。スケールは _update_layout でメインビューに合わせる）
+        roi = self.viewer.add_shapes(
+            name="ROI", edge_color=COLOR_ROI, face_color="transparent", edge_width=1
+        )
+        # 描画・頂点のドラッグ中も1フレームに1回まで統計を更新する
+        for name in ("data", "set_data", "highlight"):
+            emitter = getattr(roi.events, name, None)
+            if emitter is not None:
+                emitter.connect(scheduler.coalesced(self._update_roi_stats))
 
         # ★修正: properties={'label': []} を追加
         # これにより、初期化時点から "label" というキーが存在することをNapariに伝えます
@@ -126,6 +236,9 @@ class Slice2DController:
         self._refresh_all()
 
     def _set_main_axis(self, axis_idx):
+        # ROIはメインビューの断面の座標で持つので、主軸が変わったら消す
+        if self.main_axis != axis_idx and "ROI" in self.viewer.layers:
+            self.viewer.layers["ROI"].data = []
         self.main_axis = axis_idx
         
         label_map = {0: "Main: Axial (Z)", 1: "Main: Coronal (Y)", 2: "Main: Sagittal (X)"}
@@ -143,33 +256,100 @@ class Slice2DController:
         self.slider_slice.max = max_idx
         self.slider_slice.value = self.current_pos[self.main_axis]
 
+    @instrument()
     def _on_slider_change(self, event=None):
         if not self.data: return
         val = self.slider_slice.value
+        changed = self.current_pos[self.main_axis] != val
         self.current_pos[self.main_axis] = val
+        if changed and self.main_axis == 0 and self.on_slice_changed:
+            self.on_slice_changed(val)
+        t0 = time.perf_counter()
         self._refresh_all()
+        self.tick_ms[self.main_axis] = (time.perf_counter() - t0) * 1000
+        self.lbl_latency.value = "Tick ms  Ax {:.1f} / Co {:.1f} / Sa {:.1f}".format(*self.tick_ms)
+
+    def on_slices_loaded(self, indices):
+        """バックグラウンド読み込みで新たに届いたスライスを表示へ反映する"""
+        if not self.data or not self.widget.visible: return
+        # Coronal/Sagittalは全スライスにまたがるので毎回、Axialは表示中の位置が届いた時だけ更新
+        if self.current_pos[0] in indices:
+            self.shown_pos[0] = None
+        self.shown_pos[1] = self.shown_pos[2] = None
+        self._update_images()
+
+    def _on_slab_change(self, event=None):
+        # 投影の種類・厚さが変わったら3断面とも作り直す
+        self.shown_pos = [None, None, None]
+        self._update_images()
+
+    def _slab(self, axis: int, idx: int):
+        """厚みのある投影を表示する場合は (表示キー, 切り出し関数)、使えない場合は None"""
+        mode = self.combo_slab.value
+        if mode == "Off": return None
+        index = get_slab_index(self.data)
+        # 読み込み中・遅延読み込みの系列では通常の断面を表示する
+        if index is None: return None
+        start, stop = slab_range(idx, self.slider_slab_mm.value, self.data.voxel_spacing[axis],
+                                 self.data.volume.shape[axis])
+        return (idx, mode, start, stop), lambda: index.project(axis, start, stop, mode)
 
     def _refresh_all(self):
         self._update_images()
         self._update_crosshairs()
-
+        self._update_roi_stats()
+
+    def _update_roi_stats(self, event=None):
+        """ROIの統計を、メインビューの現在のスライス（投影ではなく元の1枚）で計算する"""
+        if not self.data or "ROI" not in self.viewer.layers: return
+        layer = self.viewer.layers["ROI"]
+        if len(layer.data) == 0:
+            self.lbl_roi.value = "Draw a rectangle, ellipse or polygon on the main view"
+            return
+        selected = sorted(layer.selected_data)
+        i = selected[0] if selected else len(layer.data) - 1
+        shape_type = layer.shape_type[i]
+        if shape_type not in ROI_SHAPES:
+            self.lbl_roi.value = f"No statistics for {shape_type}"
+            return
+        axis = self.main_axis
+        stats = shape_stats(self.data, axis, self.current_pos[axis], shape_type, layer.data[i])
+        self.lbl_roi.value = stats.summary() if stats else "ROI is outside the image"
+
+    @instrument()
     def _update_images(self):
         if not self.data: return
         
         z, y, x = self.current_pos
         vol = self.data.volume
 
-        z = np.clip(z, 0, vol.shape[0]-1)
-        y = np.clip(y, 0, vol.shape[1]-1)
-        x = np.clip(x, 0, vol.shape[2]-1)
-        
-        if "View Axial" in self.viewer.layers:
-            self.viewer.layers["View Axial"].data = vol[z, :, :]
-        if "View Coronal" in self.viewer.layers:
-            self.viewer.layers["View Coronal"].data = vol[:, y, :]
-        if "View Sagittal" in self.viewer.layers:
-            self.viewer.layers["View Sagittal"].data = vol[:, :, x]
-
+        z = int(np.clip(z, 0, vol.shape[0]-1))
+        y = int(np.clip(y, 0, vol.shape[1]-1))
+        x = int(np.clip(x, 0, vol.shape[2]-1))
+
+        # 転置コピーが使えればCoronal/Sagittalは連続メモリから取り出す
+        cache = get_reslice_cache(self.data)
+        # ディスク上・遅延のボリュームはスクロール方向に先読みしたAxialスライスを使う
+        prefetcher = get_prefetcher(self.data)
+        slicers = [
+            ("View Axial", z, lambda: prefetcher.get(z) if prefetcher else vol[z, :, :]),
+            ("View Coronal", y, lambda: cache.coronal(y) if cache else vol[:, y, :]),
+            ("View Sagittal", x, lambda: cache.sagittal(x) if cache else vol[:, :, x]),
+        ]
+        # 位置が変わったビューだけ差し替える（Axialのスクロール中にCoronal/Sagittalを作り直さない）
+        for axis, (name, idx, get_slice) in enumerate(slicers):
+            slab = self._slab(axis, idx)
+            if slab is not None:
+                idx, get_slice = slab
+            if self.shown_pos[axis] == idx or name not in self.viewer.layers: continue
+            # 切り出し（ディスク読み込み・デコードを含む）とnapariへの差し替えを分けて計測
+            with timed("2d.get_slice"):
+                plane = get_slice()
+            with timed("2d.set_data"):
+                self.viewer.layers[name].data = plane
+            self.shown_pos[axis] = idx
+
+    @instrument()
     def _update_layout(self):
         if not self.data: return
         
@@ -182,7 +362,7 @@ class Slice2DController:
         s_objs = [self.viewer.layers[s] for s in shapes]
         
         shape = self.data.volume.shape
-        sp = [self.data.slice_thickness, self.data.pixel_spacing[0], self.data.pixel_spacing[1]]
+        sp = self.data.voxel_spacing
         
         base_scales = [[sp[1], sp[2]], [sp[0], sp[2]], [sp[0], sp[1]]]
         size_z = shape[0] * sp[0]
@@ -229,6 +409,11 @@ class Slice2DController:
             sub_h = view_dims[sub_i][0] * scale_factor
             current_y += sub_h + (main_h * 0.05)
 
+        # ROIはメインビューと同じ座標系にする
+        if "ROI" in self.viewer.layers:
+            self.viewer.layers["ROI"].scale = base_scales[main_idx]
+            self.viewer.layers["ROI"].translate = [0, 0]
+
         # ラベルの更新
         self._update_labels(labels_data)
 
@@ -248,32 +433,24 @@ class Slice2DController:
         layer.properties = properties
         layer.refresh()
 
+    @instrument()
     def _update_crosshairs(self):
         if not self.data: return
 
-        for name in ["Crosshair Axial", "Crosshair Coronal", "Crosshair Sagittal"]:
-            if name in self.viewer.layers:
-                self.viewer.layers[name].data = []
-
-        if not self.chk_crosshair.value: return
-
-        z, y, x = self.current_pos
+        show = self.chk_crosshair.value
         vol_sh = self.data.volume.shape
-        
-        if "Crosshair Axial" in self.viewer.layers:
-            layer = self.viewer.layers["Crosshair Axial"]
-            lines = [[[0, x], [vol_sh[1], x]], [[y, 0], [y, vol_sh[2]]]]
-            colors = [COLOR_SAGITTAL, COLOR_CORONAL]
-            layer.add(lines, shape_type='path', edge_color=colors, edge_width=2)
-
-        if "Crosshair Coronal" in self.viewer.layers:
-            layer = self.viewer.layers["Crosshair Coronal"]
-            lines = [[[0, x], [vol_sh[0], x]], [[z, 0], [z, vol_sh[2]]]]
-            colors = [COLOR_SAGITTAL, COLOR_AXIAL]
-            layer.add(lines, shape_type='path', edge_color=colors, edge_width=2)
-            
-        if "Crosshair Sagittal" in self.viewer.layers:
-            layer = self.viewer.layers["Crosshair Sagittal"]
-            lines = [[[0, y], [vol_sh[0], y]], [[z, 0], [z, vol_sh[1]]]]
-            colors = [COLOR_CORONAL, COLOR_AXIAL]
-            layer.add(lines, shape_type='path', edge_color=colors, edge_width=2)
+
+        for name, (row_axis, col_axis, _) in CROSSHAIRS.items():
+            if name not in self.viewer.layers: continue
+            layer = self.viewer.layers[name]
+            if layer.visible != show:
+                layer.visible = show
+            if not show: continue
+
+            # 縦線: 列位置に行方向いっぱい、横線: 行位置に列方向いっぱい
+            r = self.current_pos[row_axis]
+            c = self.current_pos[col_axis]
+            vectors = self._crosshair_vectors[name]
+            vectors[0] = [[0, c], [vol_sh[row_axis], 0]]
+            vectors[1] = [[r, 0], [0, vol_sh[col_axis]]]
+            layer.data = vectors
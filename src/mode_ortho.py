@@ -1,25 +1,43 @@
+import time
 import napari
 import numpy as np
 from magicgui.widgets import Container, Label, IntSlider, CheckBox, PushButton
 
+from pyramid import InteractiveLOD, get_pyramid, pick_level, MAX_TEXTURE_SIZE
+from layer_pool import LayerPool
+from update_scheduler import scheduler
+from profiling import instrument, timed
+
 # 色定数
 COLOR_AXIAL = 'blue'
 COLOR_CORONAL = 'green'
 COLOR_SAGITTAL = 'red'
 
+# 断面レイヤー名と、それぞれが切り出す軸 (0:z, 1:y, 2:x)
+PLANE_LAYERS = {"Axial Plane": 0, "Coronal Plane": 1, "Sagittal Plane": 2}
+
 class Ortho3DController:
-    def __init__(self, viewer: napari.Viewer):
+    def __init__(self, viewer: napari.Viewer, pool: LayerPool):
         self.viewer = viewer
+        # モード切替をまたいでレイヤーを保持する
+        self.pool = pool
         self.data = None
+        # 3Dテクスチャの一辺の上限。断面はこの範囲で最も細かい段、3D Volumeは操作中だけ粗い段を使う
+        self.max_texture_size = MAX_TEXTURE_SIZE
+        self.plane_level = None
+        self.lod = None
+        # 各断面レイヤーに今表示しているスライス番号（変わった断面だけ差し替える。Noneは要更新）
+        self.shown_pos = [None, None, None]
         
         # --- UI Components ---
         self.slider_z = IntSlider(label="Axial")
         self.slider_y = IntSlider(label="Coronal")
         self.slider_x = IntSlider(label="Sagittal")
         
-        self.slider_z.changed.connect(self._update_planes)
-        self.slider_y.changed.connect(self._update_planes)
-        self.slider_x.changed.connect(self._update_planes)
+        # 3本のスライダの変更は1フレームに1回の _update_planes へまとめる
+        self.slider_z.changed.connect(scheduler.coalesced(self._update_planes))
+        self.slider_y.changed.connect(scheduler.coalesced(self._update_planes))
+        self.slider_x.changed.connect(scheduler.coalesced(self._update_planes))
 
         row_z = self._create_slider_row(self.slider_z, self._reset_z)
         row_y = self._create_slider_row(self.slider_y, self._reset_y)
@@ -28,11 +46,16 @@ class Ortho3DController:
         self.chk_3d_vol = CheckBox(value=False, label="Show 3D Volume")
         self.chk_3d_vol.changed.connect(self._update_visibility)
 
+        # GPUに転送しているデータ量とレイヤー構築時間
+        self.lbl_stats = Label(value="")
+        self.setup_ms = 0.0
+
         self.widget = Container(
             widgets=[
                 Label(value="--- Ortho Controls ---"),
                 row_z, row_y, row_x,
-                self.chk_3d_vol
+                self.chk_3d_vol,
+                self.lbl_stats
             ],
             visible=False
         )
@@ -59,6 +82,14 @@ class Ortho3DController:
 
     def set_data(self, data):
         self.data = data
+        # 前の系列のレイヤーは捨て、次の activate で作り直す
+        self.pool.release(self)
+        if not self.data:
+            # 系列なし（読み込みの中止）: 途中のボリュームから作った段も手放す
+            if self.lod:
+                self.lod.stop()
+            self.lod = self.plane_level = None
+            return
         z, y, x = data.volume.shape
         self.slider_z.max = z - 1
         self.slider_y.max = y - 1
@@ -71,70 +102,140 @@ class Ortho3DController:
         self.widget.visible = True
         self.viewer.dims.ndisplay = 3
         self.viewer.camera.angles = (135, -45, 135)
-        self._setup_layers()
+        if self.pool.has(self):
+            self.pool.show(self)
+            self._update_stats()
+        else:
+            with self.pool.collect(self):
+                self._setup_layers()
+        # 回転・ズーム中は3D Volumeを粗い段で描画する
+        self.viewer.camera.events.angles.connect(self._on_interaction)
+        self.viewer.camera.events.zoom.connect(self._on_interaction)
 
     def deactivate(self):
         self.widget.visible = False
+        self.viewer.camera.events.angles.disconnect(self._on_interaction)
+        self.viewer.camera.events.zoom.disconnect(self._on_interaction)
+        # 先に隠してから細かい段へ戻す（非表示のレイヤーはnapariが転送しない）
+        self.pool.hide(self)
+        if self.lod:
+            self.lod.stop()
+
+    def _on_interaction(self, event=None):
+        if self.lod and self.chk_3d_vol.value:
+            self.lod.interact()
 
+    @instrument()
     def _setup_layers(self):
         if not self.data: return
-        scale = [self.data.slice_thickness, self.data.pixel_spacing[0], self.data.pixel_spacing[1]]
+        t0 = time.perf_counter()
+        scale = self.data.voxel_spacing
+        levels = get_pyramid(self.data)
+        self.plane_level = levels[pick_level(levels, self.max_texture_size)]
         
         # 平面表示の設定
-        # depiction='plane' を使うとGPUで断面計算を行うため高速です
+        # 各断面は厚さ1ボクセルの板だけを渡すので、ボリューム全体をGPUへ送るのは3D Volumeの1枚だけで済む
         params = {
-            "scale": scale, 
+            "scale": self.plane_level.scale(scale), 
             "colormap": "gray", 
             "blending": "translucent_no_depth", 
             "depiction": "plane", 
             "rendering": "mip"
         }
         
-        self.viewer.add_image(self.data.volume, name="Axial Plane", plane={"normal": (1,0,0)}, **params)
-        self.viewer.add_image(self.data.volume, name="Coronal Plane", plane={"normal": (0,1,0)}, **params)
-        self.viewer.add_image(self.data.volume, name="Sagittal Plane", plane={"normal": (0,0,1)}, **params)
+        positions = (self.slider_z.value, self.slider_y.value, self.slider_x.value)
+        for name, axis in PLANE_LAYERS.items():
+            slab, translate = self._plane_slab(axis, positions[axis])
+            normal = [0, 0, 0]
+            normal[axis] = 1
+            self.viewer.add_image(slab, name=name, translate=translate,
+                                  plane={"normal": tuple(normal), "position": (0, 0, 0)}, **params)
+        self.shown_pos = list(positions)
         
-        # 3D Volume (全体像)
-        self.viewer.add_image(
-            self.data.volume, name="3D Volume", scale=scale, 
+        # 3D Volume (全体像)。非表示の間はnapariがデータを転送しない
+        if self.lod:
+            self.lod.stop()
+        self.lod = InteractiveLOD(levels, scale, self.max_texture_size)
+        layer = self.viewer.add_image(
+            name="3D Volume", 
             colormap="gray", blending="additive", rendering="mip", 
-            visible=self.chk_3d_vol.value
+            visible=self.chk_3d_vol.value,
+            **self.lod.layer_kwargs()
         )
+        self.lod.attach(layer)
 
-        # ★追加: 枠線用のShapesレイヤー
+        # ★追加: 枠線用のレイヤー
+        # 3つの長方形の各辺 (4辺 x 3) を (始点, 方向) で持つVectorsレイヤー。
+        # Shapesと違い座標を書き換えるだけで済み、三角形分割のやり直しが無い
         # ここにも scale を渡すのが重要です！
-        self.viewer.add_shapes(
+        self.viewer.add_vectors(
+            np.zeros((12, 2, 3)),
             name="Ortho Frames",
             edge_width=3,          # 線の太さ
-            face_color=[0,0,0,0],  # 塗りつぶしなし（透明）
-            ndim=3,
+            edge_color=[COLOR_AXIAL] * 4 + [COLOR_CORONAL] * 4 + [COLOR_SAGITTAL] * 4,
+            vector_style="line",
+            length=1,
             scale=scale            # 画像と同じスケールを適用
         )
 
-        self._update_planes()
+        self._update_planes(force=True)
+        self.setup_ms = (time.perf_counter() - t0) * 1000
+        self._update_stats()
+
+    def _plane_slab(self, axis, idx):
+        """断面用に、段のボリュームから axis 方向に厚さ1ボクセルの板と、その配置位置を返す"""
+        level = self.plane_level
+        scale = self.data.voxel_spacing
+        pos = [0, 0, 0]
+        pos[axis] = idx
+        i = int(np.clip(round(level.to_level(pos)[axis]), 0, level.data.shape[axis] - 1))
+
+        slicer = [slice(None)] * 3
+        slicer[axis] = slice(i, i + 1)
+        translate = level.translate(scale)
+        translate[axis] += i * level.scale(scale)[axis]
+        return level.data[tuple(slicer)], translate
+
+    def texture_bytes(self) -> int:
+        """このモードで表示中のレイヤーがGPUへ転送するデータ量の目安"""
+        total = 0
+        for name in list(PLANE_LAYERS) + ["3D Volume"]:
+            if name in self.viewer.layers and self.viewer.layers[name].visible:
+                total += self.viewer.layers[name].data.nbytes
+        return total
+
+    def _update_stats(self):
+        self.lbl_stats.value = f"Textures: {self.texture_bytes() / 1024**2:.1f} MB, setup {self.setup_ms:.0f} ms"
 
-    def _update_planes(self, event=None):
+    @instrument()
+    def _update_planes(self, event=None, force: bool = False):
         if not self.widget.visible or not self.data: return
         
         z_idx = self.slider_z.value
         y_idx = self.slider_y.value
         x_idx = self.slider_x.value
+        positions = (z_idx, y_idx, x_idx)
+        # スライダ1本の操作なら、切り出し直すのはその軸の断面1枚だけ
+        changed = [axis for axis in range(3) if positions[axis] != self.shown_pos[axis]]
+        if not changed and not force: return
 
-        # 1. 画像平面の位置更新
+        # 1. 画像平面の更新（位置が変わった板だけを切り出し直して移動）
         if "Axial Plane" in self.viewer.layers:
-            self.viewer.layers["Axial Plane"].plane.position = (z_idx, 0, 0)
-            self.viewer.layers["Coronal Plane"].plane.position = (0, y_idx, 0)
-            self.viewer.layers["Sagittal Plane"].plane.position = (0, 0, x_idx)
+            for name, axis in PLANE_LAYERS.items():
+                if axis not in changed: continue
+                layer = self.viewer.layers[name]
+                slab, translate = self._plane_slab(axis, positions[axis])
+                with timed("ortho.set_data"):
+                    layer.data, layer.translate = slab, translate
+                self.shown_pos[axis] = positions[axis]
 
         # 2. 枠線の更新
         if "Ortho Frames" in self.viewer.layers:
             layer = self.viewer.layers["Ortho Frames"]
-            layer.data = [] # 一旦クリア
 
             z_dim, y_dim, x_dim = self.data.volume.shape
             
             shapes = []
-            colors = []
 
             # Axial枠 (青): z=z_idx で固定、XY平面の長方形
             rect_axial = [
@@ -145,7 +246,6 @@ class Ortho3DController:
                 [z_idx, 0, 0] # 閉じる
             ]
             shapes.append(rect_axial)
-            colors.append(COLOR_AXIAL)
 
             # Coronal枠 (緑): y=y_idx で固定、XZ平面の長方形
             rect_coronal = [
@@ -156,7 +256,6 @@ class Ortho3DController:
                 [0, y_idx, 0] # 閉じる
             ]
             shapes.append(rect_coronal)
-            colors.append(COLOR_CORONAL)
 
             # Sagittal枠 (赤): x=x_idx で固定、YZ平面の長方形
             rect_sagittal = [
@@ -167,11 +266,14 @@ class Ortho3DController:
                 [0, 0, x_idx] # 閉じる
             ]
             shapes.append(rect_sagittal)
-            colors.append(COLOR_SAGITTAL)
 
-            # まとめて描画
-            layer.add(shapes, shape_type='path', edge_color=colors)
+            # 長方形の頂点列を辺ごとの (始点, 方向) に変換してまとめて差し替え
+            corners = np.array(shapes, dtype=float)
+            vectors = np.stack([corners[:, :-1], np.diff(corners, axis=1)], axis=2)
+            with timed("ortho.frames"):
+                layer.data = vectors.reshape(-1, 2, 3)
 
     def _update_visibility(self):
         if "3D Volume" in self.viewer.layers:
-            self.viewer.layers["3D Volume"].visible = self.chk_3d_vol.value
\ No newline at end of file
+            self.viewer.layers["3D Volume"].visible = self.chk_3d_vol.value
+            self._update_stats()
\ No newline at end of file
@@ -1,11 +1,30 @@
 import napari
 import numpy as np
-from magicgui.widgets import Container, Label, PushButton, FloatSlider, RangeSlider
+from magicgui.widgets import Container, Label, PushButton, FloatSlider, RangeSlider, CheckBox, ComboBox
+from napari.qt.threading import create_worker
+from qtpy.QtCore import QTimer
+
+from pyramid import InteractiveLOD, get_pyramid, MAX_TEXTURE_SIZE, IDLE_MS
+from oblique_mpr import get_oblique_resampler, rotation_matrix
+from windowing import value_range_of
+from roi_stats import box_stats
+from surface import get_mesh_cache
+from layer_pool import LayerPool
+from update_scheduler import scheduler
+from profiling import instrument
+
+# 等値面を抽出するピラミッドの段（元ボリュームに対する縮小率）
+SURFACE_LEVELS = ["1x", "2x", "4x", "8x"]
 
 class Volume3DController:
-    def __init__(self, viewer: napari.Viewer):
+    def __init__(self, viewer: napari.Viewer, pool: LayerPool):
         self.viewer = viewer
+        # モード切替をまたいでレイヤーを保持する
+        self.pool = pool
         self.data = None
+        # 3Dテクスチャの一辺の上限と、操作中/静止時の段の切り替え
+        self.max_texture_size = MAX_TEXTURE_SIZE
+        self.lod = None
         
         # --- Transform Sliders ---
         self.slider_tx = FloatSlider(min=-200, max=200, label="Pos X")
@@ -15,19 +34,63 @@ class Volume3DController:
         self.slider_pitch = FloatSlider(min=-180, max=180, label="Pitch (Y)")
         self.slider_yaw = FloatSlider(min=-180, max=180, label="Yaw (X)")
         
+        # --- Oblique MPR: 回転スライダの向きの断面を2Dで表示 ---
+        self.chk_oblique = CheckBox(value=False, label="Oblique 2D View")
+        self.slider_offset = FloatSlider(min=-200, max=200, label="Slice Offset")
+        # ドラッグ中は粗いプレビューを出し、止まってから等倍で切り出し直す
+        self._oblique_timer = QTimer()
+        self._oblique_timer.setSingleShot(True)
+        self._oblique_timer.setInterval(IDLE_MS)
+        self._oblique_timer.timeout.connect(lambda: self._update_oblique(preview=False))
+
+        # --- Surface: 閾値の等値面をバックグラウンドで抽出して表示（閾値・段ごとにキャッシュ） ---
+        self.chk_surface = CheckBox(value=False, label="Surface Mode")
+        self.slider_threshold = FloatSlider(value=300, min=-1000, max=3000, step=1, label="Threshold")
+        # 抽出に使うピラミッドの段（粗いほど速く、面数も少ない）
+        self.combo_surface_level = ComboBox(choices=SURFACE_LEVELS, value=SURFACE_LEVELS[1], label="Surface Level")
+        self.lbl_surface = Label(value="")
+        self.surface_worker = None
+        # 抽出に失敗した (閾値, 段)。同じ設定での再試行を繰り返さない
+        self._surface_failed = None
+        # 閾値スライダは止まってから抽出する（作成済みの組み合わせは即座に切り替える）
+        self._surface_timer = QTimer()
+        self._surface_timer.setSingleShot(True)
+        self._surface_timer.setInterval(IDLE_MS)
+        self._surface_timer.timeout.connect(self._request_surface)
+
+        # 切り出し: 操作が止まったらクリッピング範囲の部分ボリュームだけをGPUへ送る
+        self.chk_hard_crop = CheckBox(value=False, label="Hard Crop")
+
+        # --- Box ROI: クリッピング範囲の直方体の統計 ---
+        self.chk_box_roi = CheckBox(value=False, label="Box ROI Stats")
+        self.lbl_box_roi = Label(value="")
+        # ドラッグ中は累積和から平均・SDだけを出し、止まってから min / max / ヒストグラムも出す
+        self._roi_timer = QTimer()
+        self._roi_timer.setSingleShot(True)
+        self._roi_timer.setInterval(IDLE_MS)
+        self._roi_timer.timeout.connect(lambda: self._update_box_roi(extremes=True))
+
         # --- Clipping Sliders ---
         self.range_z = RangeSlider(label="Clip Z")
         self.range_y = RangeSlider(label="Clip Y")
         self.range_x = RangeSlider(label="Clip X")
 
-        # イベント接続
+        # イベント接続（ドラッグ中の連続した changed は1フレームに1回へまとめる）
         transform_sliders = [self.slider_tx, self.slider_ty, self.slider_tz, 
                              self.slider_roll, self.slider_pitch, self.slider_yaw]
         for w in transform_sliders:
-            w.changed.connect(self._update_transform)
+            w.changed.connect(scheduler.coalesced(self._on_transform_slider))
 
         for w in [self.range_z, self.range_y, self.range_x]:
-            w.changed.connect(self._update_clipping)
+            w.changed.connect(scheduler.coalesced(self._on_clip_slider))
+
+        self.chk_oblique.changed.connect(self._apply_view)
+        self.chk_surface.changed.connect(self._apply_view)
+        self.slider_threshold.changed.connect(self._on_surface_setting)
+        self.combo_surface_level.changed.connect(self._on_surface_setting)
+        self.chk_hard_crop.changed.connect(self._apply_crop)
+        self.chk_box_roi.changed.connect(lambda: self._update_box_roi(extremes=True))
+        self.slider_offset.changed.connect(scheduler.coalesced(self._on_oblique_drag))
 
         # --- UI Layout (With Reset Buttons) ---
         widgets = [Label(value="--- Transform ---")]
@@ -36,6 +99,16 @@ class Volume3DController:
         for s in transform_sliders:
             widgets.append(self._create_row(s, 0.0))
             
+        widgets.append(Label(value="--- Oblique MPR ---"))
+        widgets.append(self.chk_oblique)
+        widgets.append(self._create_row(self.slider_offset, 0.0))
+
+        widgets.append(Label(value="--- Surface ---"))
+        widgets.append(self.chk_surface)
+        widgets.append(self.slider_threshold)
+        widgets.append(self.combo_surface_level)
+        widgets.append(self.lbl_surface)
+
         widgets.append(Label(value="--- Clipping ---"))
         
         # Clipping用の行作成 (リセット先は動的だが、ここではボタンだけ配置)
@@ -44,6 +117,9 @@ class Volume3DController:
         widgets.append(self._create_clip_row(self.range_z))
         widgets.append(self._create_clip_row(self.range_y))
         widgets.append(self._create_clip_row(self.range_x))
+        widgets.append(self.chk_hard_crop)
+        widgets.append(self.chk_box_roi)
+        widgets.append(self.lbl_box_roi)
 
         self.widget = Container(widgets=widgets, visible=False)
 
@@ -75,6 +151,14 @@ class Volume3DController:
 
     def set_data(self, data):
         self.data = data
+        # 前の系列のレイヤーは捨て、次の activate で作り直す
+        self.pool.release(self)
+        if not self.data:
+            # 系列なし（読み込みの中止）: 途中のボリュームから作った段も手放す
+            if self.lod:
+                self.lod.stop()
+            self.lod = None
+            return
         z, y, x = data.volume.shape
         
         # 範囲設定
@@ -87,49 +171,229 @@ class Volume3DController:
         self.range_y.value = (0, y)
         self.range_x.value = (0, x)
 
+        # 断面の移動範囲は中心から対角線の半分まで
+        half = float(np.linalg.norm(np.multiply((z, y, x), data.voxel_spacing))) / 2
+        self.slider_offset.min, self.slider_offset.max = -half, half
+        self.slider_offset.value = 0.0
+
+        # 閾値は系列の値の範囲で選ぶ
+        lo, hi = value_range_of(data)
+        self.slider_threshold.min, self.slider_threshold.max = lo, hi
+        self.slider_threshold.value = float(np.clip(self.slider_threshold.value, lo, hi))
+        self._surface_failed = None
+        self.lbl_surface.value = ""
+
     def activate(self):
         self.widget.visible = True
         self.viewer.dims.ndisplay = 3
         self.viewer.camera.angles = (135, -45, 135)
-        self._setup_layers()
+        if self.pool.has(self):
+            self.pool.show(self)
+        else:
+            with self.pool.collect(self):
+                self._setup_layers()
+        self._apply_view()
+        # 回転・ズーム中は粗い段で描画する
+        self.viewer.camera.events.angles.connect(self._on_interaction)
+        self.viewer.camera.events.zoom.connect(self._on_interaction)
 
     def deactivate(self):
         self.widget.visible = False
+        self._oblique_timer.stop()
+        self._roi_timer.stop()
+        self._surface_timer.stop()
+        self.viewer.camera.events.angles.disconnect(self._on_interaction)
+        self.viewer.camera.events.zoom.disconnect(self._on_interaction)
+        # 先に隠してから細かい段へ戻す（非表示のレイヤーはnapariが転送しない）
+        self.pool.hide(self)
+        if self.lod:
+            self.lod.stop()
+
+    def _on_interaction(self, event=None):
+        # 斜断面・等値面の表示中はボリュームは非表示なので段を切り替えない
+        if self.lod and not self.chk_oblique.value and not self.chk_surface.value:
+            self.lod.interact()
+
+    def _apply_view(self, event=None):
+        """3D表示（MIP / 等値面）と斜断面の2D表示を切り替える"""
+        if "Voxel Volume" not in self.viewer.layers: return
+        oblique = self.chk_oblique.value
+        surface = self.chk_surface.value and not oblique
+        self.viewer.layers["Voxel Volume"].visible = not oblique and not surface
+        self.viewer.layers["Oblique MPR"].visible = oblique
+        self.viewer.layers["Iso Surface"].visible = surface
+        self.viewer.dims.ndisplay = 2 if oblique else 3
+        if oblique:
+            self._update_oblique(preview=False)
+            self.viewer.reset_view()
+        if surface:
+            self._request_surface()
+
+    def _surface_key(self) -> tuple[float, int]:
+        levels = get_pyramid(self.data)
+        level = min(SURFACE_LEVELS.index(self.combo_surface_level.value), len(levels) - 1)
+        return round(float(self.slider_threshold.value), 1), level
+
+    def _on_surface_setting(self, event=None):
+        if not self.chk_surface.value or not self.data: return
+        # 作成済みならその場で切り替え、無ければスライダが止まってから抽出する
+        mesh = get_mesh_cache(self.data).get(*self._surface_key())
+        if mesh is not None:
+            self._show_mesh(mesh)
+        else:
+            self._surface_timer.start()
+
+    def _request_surface(self):
+        if not self.chk_surface.value or not self.data or "Iso Surface" not in self.viewer.layers: return
+        key = self._surface_key()
+        cache = get_mesh_cache(self.data)
+        mesh = cache.get(*key)
+        if mesh is not None:
+            self._show_mesh(mesh)
+            return
+        # 抽出中なら、終わった時点の設定で改めて要求する
+        if self.surface_worker is not None or key == self._surface_failed: return
+        self.lbl_surface.value = f"Extracting surface at {key[0]:g} ..."
+        worker = create_worker(cache.build, *key)
+        worker.errored.connect(lambda e, key=key: self._on_surface_error(key, e))
+        worker.finished.connect(self._on_surface_finished)
+        self.surface_worker = worker
+        worker.start()
 
+    def _on_surface_error(self, key, e: Exception):
+        self._surface_failed = key
+        self.lbl_surface.value = f"Surface failed: {e}"
+
+    def _on_surface_finished(self):
+        self.surface_worker = None
+        self._request_surface()
+
+    def _show_mesh(self, mesh):
+        layer = self.viewer.layers["Iso Surface"]
+        layer.data = mesh.layer_data()
+        self.lbl_surface.value = (f"{len(mesh.faces):,} faces (from {mesh.raw_faces:,}), "
+                                  f"{mesh.seconds * 1000:.0f} ms")
+        self._update_transform()
+        self._update_clipping()
+
+    def _on_oblique_drag(self, event=None):
+        if not self.chk_oblique.value: return
+        self._update_oblique(preview=True)
+        self._oblique_timer.start()
+
+    @instrument()
+    def _update_oblique(self, preview: bool = False):
+        if not self.chk_oblique.value or "Oblique MPR" not in self.viewer.layers: return
+        resampler = get_oblique_resampler(self.data)
+        angles = (self.slider_roll.value, self.slider_pitch.value, self.slider_yaw.value)
+        plane = resampler.reslice(angles, self.slider_offset.value, value_range_of(self.data)[0], preview)
+        pixel = resampler.output_pixel(preview)
+        layer = self.viewer.layers["Oblique MPR"]
+        # プレビューと等倍で画素数が違っても、中心と物理的な大きさは揃える
+        layer.data = plane
+        layer.scale = (pixel, pixel)
+        layer.translate = (-(plane.shape[0] - 1) / 2 * pixel, -(plane.shape[1] - 1) / 2 * pixel)
+
+    @instrument()
     def _setup_layers(self):
         if not self.data: return
-        scale = [self.data.slice_thickness, self.data.pixel_spacing[0], self.data.pixel_spacing[1]]
-        self.viewer.add_image(
-            self.data.volume, name="Voxel Volume", scale=scale, colormap="gray",
-            blending="additive", rendering="mip", interpolation3d="linear"
+        scale = self.data.voxel_spacing
+        if self.lod:
+            self.lod.stop()
+        self.lod = InteractiveLOD(
+            get_pyramid(self.data), scale, self.max_texture_size,
+            on_level_change=self._update_clipping
+        )
+        layer = self.viewer.add_image(
+            name="Voxel Volume", colormap="gray",
+            blending="additive", rendering="mip", interpolation3d="linear",
+            **self.lod.layer_kwargs()
+        )
+        self.lod.attach(layer)
+        self._apply_crop()
+        # 斜断面の2D表示用（表示するまでは空）
+        self.viewer.add_image(np.zeros((2, 2), dtype=np.float32), name="Oblique MPR",
+                              colormap="gray", visible=False)
+        # 等値面（頂点は物理座標 [mm]。抽出するまでは三角形1枚のダミー）
+        self.viewer.add_surface(
+            (np.zeros((3, 3), dtype=np.float32), np.array([[0, 1, 2]]), np.ones(3, dtype=np.float32)),
+            name="Iso Surface", colormap="bone", contrast_limits=(0, 1), shading="smooth", visible=False
         )
         # Transformリセット
         self.slider_tx.value = self.slider_ty.value = self.slider_tz.value = 0
         self.slider_roll.value = self.slider_pitch.value = self.slider_yaw.value = 0
         self._update_clipping()
 
+    @instrument()
     def _update_transform(self, event=None):
         if "Voxel Volume" not in self.viewer.layers: return
-        roll, pitch, yaw = np.radians(self.slider_roll.value), np.radians(self.slider_pitch.value), np.radians(self.slider_yaw.value)
-        c, s = np.cos(roll), np.sin(roll)
-        Rz = np.array([[1, 0, 0, 0], [0, c, -s, 0], [0, s, c, 0], [0, 0, 0, 1]])
-        c, s = np.cos(pitch), np.sin(pitch)
-        Ry = np.array([[c, 0, s, 0], [0, 1, 0, 0], [-s, 0, c, 0], [0, 0, 0, 1]])
-        c, s = np.cos(yaw), np.sin(yaw)
-        Rx = np.array([[c, -s, 0, 0], [s, c, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
-        
-        T = np.eye(4)
-        T[0:3, 3] = [self.slider_tz.value, self.slider_ty.value, self.slider_tx.value]
-        self.viewer.layers["Voxel Volume"].affine = T @ Rz @ Ry @ Rx
+        # 斜断面（oblique_mpr）と同じ回転行列を使う
+        A = np.eye(4)
+        A[0:3, 0:3] = rotation_matrix(self.slider_roll.value, self.slider_pitch.value, self.slider_yaw.value)
+        A[0:3, 3] = [self.slider_tz.value, self.slider_ty.value, self.slider_tx.value]
+        self.viewer.layers["Voxel Volume"].affine = A
+        if "Iso Surface" in self.viewer.layers:
+            self.viewer.layers["Iso Surface"].affine = A
+
+    def _on_transform_slider(self, event=None):
+        self._on_interaction()
+        self._update_transform()
+        self._on_oblique_drag()
+
+    def _on_clip_slider(self, event=None):
+        self._on_interaction()
+        # ドラッグ中はクリッピング面で切り、部分ボリュームの転送は操作が止まってから
+        self._apply_crop()
+        self._update_clipping()
+        if self.chk_box_roi.value:
+            self._update_box_roi(extremes=False)
+            self._roi_timer.start()
 
+    def _update_box_roi(self, extremes: bool = True):
+        if not self.chk_box_roi.value or not self.data:
+            self.lbl_box_roi.value = ""
+            return
+        box = (self.range_z.value, self.range_y.value, self.range_x.value)
+        stats = box_stats(self.data, box, extremes=extremes)
+        self.lbl_box_roi.value = stats.summary() if stats else "Empty box"
+
+    def _crop_box(self):
+        """Hard Crop が有効で、クリッピング範囲が全体より小さい場合だけ範囲を返す"""
+        if not self.chk_hard_crop.value or not self.data: return None
+        box = tuple(tuple(int(v) for v in r.value) for r in (self.range_z, self.range_y, self.range_x))
+        if box == tuple((0, n) for n in self.data.volume.shape): return None
+        if any(lo >= hi for lo, hi in box): return None
+        return box
+
+    def _apply_crop(self, event=None):
+        if self.lod:
+            self.lod.set_crop(self._crop_box())
+
+    @instrument()
     def _update_clipping(self, event=None):
         if "Voxel Volume" not in self.viewer.layers: return
         z_min, z_max = self.range_z.value
         y_min, y_max = self.range_y.value
         x_min, x_max = self.range_x.value
+        # クリッピング面の位置は表示中のデータ（段・切り出し後）のボクセル座標で指定する
+        if self.lod:
+            level, origin = self.lod.level, self.lod.origin
+            to_level = lambda pos: tuple(p - o for p, o in zip(level.to_level(pos), origin))
+        else:
+            to_level = lambda pos: pos
         planes = [
-            {"position": (z_min, 0, 0), "normal": (1, 0, 0)}, {"position": (z_max, 0, 0), "normal": (-1, 0, 0)},
-            {"position": (0, y_min, 0), "normal": (0, 1, 0)}, {"position": (0, y_max, 0), "normal": (0, -1, 0)},
-            {"position": (0, 0, x_min), "normal": (0, 0, 1)}, {"position": (0, 0, x_max), "normal": (0, 0, -1)}
+            {"position": to_level((z_min, 0, 0)), "normal": (1, 0, 0)}, {"position": to_level((z_max, 0, 0)), "normal": (-1, 0, 0)},
+            {"position": to_level((0, y_min, 0)), "normal": (0, 1, 0)}, {"position": to_level((0, y_max, 0)), "normal": (0, -1, 0)},
+            {"position": to_level((0, 0, x_min)), "normal": (0, 0, 1)}, {"position": to_level((0, 0, x_max)), "normal": (0, 0, -1)}
         ]
-        self.viewer.layers["Voxel Volume"].experimental_clipping_planes = planes
\ No newline at end of file
+        self.viewer.layers["Voxel Volume"].experimental_clipping_planes = planes
+
+        # 等値面は物理座標なのでボクセル番号に間隔を掛ける
+        if "Iso Surface" in self.viewer.layers:
+            sp = self.data.voxel_spacing
+            self.viewer.layers["Iso Surface"].experimental_clipping_planes = [
+                {"position": tuple(np.multiply(pos, sp)), "normal": normal}
+                for pos, normal in (((z_min, 0, 0), (1, 0, 0)), ((z_max, 0, 0), (-1, 0, 0)),
+                                    ((0, y_min, 0), (0, 1, 0)), ((0, y_max, 0), (0, -1, 0)),
+                                    ((0, 0, x_min), (0, 0, 1)), ((0, 0, x_max), (0, 0, -1)))
+            ]
\ No newline at end of file
@@ -0,0 +1,81 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from profiling import instrument
+
+# スクロール方向に先読みするスライス数
+PREFETCH_DEPTH = 8
+# 先読み用のスレッド数（全系列で共有）
+PREFETCH_WORKERS = 2
+
+_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+class SlicePrefetcher:
+    """
+    ディスク上（memmap）や遅延（dask）のボリュームで、Axialスライスを
+    スクロール方向に PREFETCH_DEPTH 枚先まで裏で読み込んでおく。
+    読み込んだスライスは直近の分だけ保持する
+    """
+    def __init__(self, volume, depth: int = PREFETCH_DEPTH):
+        self.volume = volume
+        self.depth = depth
+        self._slices: OrderedDict[int, np.ndarray] = OrderedDict()
+        self._pending: dict[int, Future] = {}
+        self._lock = threading.Lock()
+        self._last = None
+        self.hits = 0
+        self.misses = 0
+
+    @instrument("prefetch.read")
+    def _read(self, z: int) -> np.ndarray:
+        try:
+            # memmapはページキャッシュから連続メモリへ、daskはデコードまで済ませる
+            out = np.array(self.volume[z])
+            with self._lock:
+                self._slices[z] = out
+                self._slices.move_to_end(z)
+                while len(self._slices) > 2 * self.depth + 1:
+                    self._slices.popitem(last=False)
+            return out
+        finally:
+            with self._lock:
+                self._pending.pop(z, None)
+
+    def get(self, z: int) -> np.ndarray:
+        """z 枚目を返し、前回からの移動方向に次のスライスの先読みを始める"""
+        direction = 1 if self._last is None or z >= self._last else -1
+        self._last = z
+        with self._lock:
+            cached = self._slices.get(z)
+            future = self._pending.get(z)
+        if cached is not None:
+            self.hits += 1
+            result = cached
+        elif future is not None:
+            self.hits += 1
+            result = future.result()
+        else:
+            self.misses += 1
+            result = self._read(z)
+        self._schedule(z, direction)
+        return result
+
+    def _schedule(self, z: int, direction: int):
+        n = self.volume.shape[0]
+        with self._lock:
+            for i in range(1, self.depth + 1):
+                nz = z + direction * i
+                if not 0 <= nz < n: break
+                if nz in self._slices or nz in self._pending: continue
+                self._pending[nz] = _pool.submit(self._read, nz)
+
+def get_prefetcher(data) -> SlicePrefetcher | None:
+    """メモリ上の通常のボリュームでは先読み不要なので None"""
+    vol = data.volume
+    if type(vol) is np.ndarray:
+        return None
+    if "prefetch" not in data.derived:
+        data.derived["prefetch"] = SlicePrefetcher(vol)
+    return data.derived["prefetch"]
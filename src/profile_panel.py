@@ -0,0 +1,71 @@
+from magicgui.widgets import Container, Label, PushButton, Table
+from qtpy.QtCore import QTimer
+
+from profiling import profiler
+from update_scheduler import scheduler
+
+# 表示中の統計を更新する間隔
+REFRESH_MS = 500
+
+class ProfilePanel:
+    """
+    処理ごとの所要時間 (p50 / p95 / 最大) と更新スケジューラの実行・破棄数を表示するドック。
+    統計の更新は表示中だけ行う。記録ボタンで cProfile と Chrome trace をファイルに書き出す
+    """
+    def __init__(self, on_session_stopped=None):
+        # 記録を止めた後に呼ぶ（計測を続けるかはメニューの状態で決める）
+        self.on_session_stopped = on_session_stopped
+        self.table = Table(value={"data": [], "columns": ["Name", "Count", "p50 ms", "p95 ms", "Max ms"]})
+        self.table.read_only = True
+        self.lbl_scheduler = Label(value="")
+        self.lbl_session = Label(value="")
+
+        self.btn_record = PushButton(text="Start Recording")
+        self.btn_record.clicked.connect(self._on_record_clicked)
+        self.btn_reset = PushButton(text="Reset")
+        self.btn_reset.clicked.connect(self._on_reset_clicked)
+
+        self.widget = Container(
+            widgets=[
+                self.lbl_scheduler,
+                self.table,
+                Container(widgets=[self.btn_record, self.btn_reset], layout="horizontal", labels=False),
+                self.lbl_session,
+            ],
+            labels=False,
+        )
+        self._timer = QTimer()
+        self._timer.setInterval(REFRESH_MS)
+        self._timer.timeout.connect(self.refresh)
+
+    def start(self):
+        self.refresh()
+        self._timer.start()
+
+    def stop(self):
+        self._timer.stop()
+
+    def refresh(self):
+        self.lbl_scheduler.value = f"Scheduler: applied {scheduler.applied} / dropped {scheduler.dropped}"
+        rows = [
+            [r["name"], r["count"], f"{r['p50']:.1f}", f"{r['p95']:.1f}", f"{r['max']:.1f}"]
+            for r in profiler.stats()
+        ]
+        self.table.value = {"data": rows, "columns": ["Name", "Count", "p50 ms", "p95 ms", "Max ms"]}
+
+    def _on_record_clicked(self):
+        if not profiler.recording:
+            profiler.start_session()
+            self.btn_record.text = "Stop & Save"
+            self.lbl_session.value = "Recording..."
+            return
+        paths = profiler.stop_session()
+        if self.on_session_stopped is not None:
+            self.on_session_stopped()
+        self.btn_record.text = "Start Recording"
+        self.lbl_session.value = "Saved:\n" + "\n".join(str(p) for p in paths) if paths else ""
+
+    def _on_reset_clicked(self):
+        profiler.reset()
+        scheduler.applied = scheduler.dropped = 0
+        self.refresh()
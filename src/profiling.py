@@ -0,0 +1,113 @@
+import os
+import time
+import json
+import cProfile
+import threading
+import functools
+import numpy as np
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+# 1 で起動時から計測する（メニューの Debug > Profiling でも切り替えられる）
+PROFILE_ENABLED = os.environ.get("DICOM_VIEWER_PROFILE", "0") not in ("", "0")
+# 記録したセッションの保存先
+PROFILE_DIR = Path(os.environ.get("DICOM_VIEWER_PROFILE_DIR", Path.home() / ".dicom_viewer" / "profiles"))
+# 処理ごとに保持する直近の計測数（ローリングヒストグラム）
+HISTORY = 500
+
+class Profiler:
+    """
+    処理名ごとの所要時間を直近 HISTORY 回分保持する。
+    無効の間は timed / instrument のコストはフラグの確認1回だけ。
+    記録中（start_session 〜 stop_session）は Chrome trace 形式のイベントと cProfile も取る
+    """
+    def __init__(self, enabled: bool = PROFILE_ENABLED):
+        self.enabled = enabled
+        self._samples: dict[str, deque] = {}
+        self._trace: list[dict] | None = None
+        self._cprofile: cProfile.Profile | None = None
+        self._t0 = time.perf_counter()
+
+    def record(self, name: str, seconds: float, start: float | None = None):
+        samples = self._samples.get(name)
+        if samples is None:
+            samples = self._samples.setdefault(name, deque(maxlen=HISTORY))
+        samples.append(seconds)
+        if self._trace is not None and start is not None:
+            self._trace.append({
+                "name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                "ts": (start - self._t0) * 1e6, "dur": seconds * 1e6,
+            })
+
+    @contextmanager
+    def timed(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, start)
+
+    def instrument(self, name: str | None = None):
+        """関数の所要時間を name（既定は 関数の修飾名）で記録するデコレータ"""
+        def decorator(func):
+            label = name or func.__qualname__
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(label, time.perf_counter() - start, start)
+            return wrapper
+        return decorator
+
+    def stats(self) -> list[dict]:
+        """処理ごとの回数と p50 / p95 / 最大 (ms)。p95 の大きい順"""
+        rows = []
+        for name, samples in list(self._samples.items()):
+            if not samples: continue
+            ms = np.fromiter(samples, dtype=np.float64) * 1000
+            p50, p95 = np.percentile(ms, [50, 95])
+            rows.append({"name": name, "count": len(ms), "p50": float(p50), "p95": float(p95), "max": float(ms.max())})
+        rows.sort(key=lambda r: r["p95"], reverse=True)
+        return rows
+
+    def reset(self):
+        self._samples.clear()
+
+    @property
+    def recording(self) -> bool:
+        return self._trace is not None
+
+    def start_session(self):
+        """記録を始める（計測も有効にする）。cProfile はメインスレッドだけが対象"""
+        self.enabled = True
+        self._trace = []
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+
+    def stop_session(self, out_dir: Path = PROFILE_DIR) -> tuple[Path, Path] | None:
+        """記録を止め、cProfile (.prof) と Chrome trace (.json) を書き出してパスを返す"""
+        if self._trace is None: return None
+        self._cprofile.disable()
+        out_dir.mkdir(parents=True, exist_ok=True)
+        stem = out_dir / time.strftime("session-%Y%m%d-%H%M%S")
+        prof_path = stem.with_suffix(".prof")
+        trace_path = stem.with_suffix(".json")
+        self._cprofile.dump_stats(prof_path)
+        # chrome://tracing や Perfetto で開ける形式
+        trace_path.write_text(json.dumps({"traceEvents": self._trace, "displayTimeUnit": "ms"}), encoding="utf-8")
+        self._trace = None
+        self._cprofile = None
+        return prof_path, trace_path
+
+# アプリ全体で共有するプロファイラ
+profiler = Profiler()
+timed = profiler.timed
+instrument = profiler.instrument
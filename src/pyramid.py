@@ -0,0 +1,169 @@
+import os
+import numpy as np
+from dataclasses import dataclass
+from qtpy.QtCore import QTimer
+
+from profiling import instrument
+
+# GPUへ渡す3Dテクスチャの一辺の上限（これを超える段は使わない）
+MAX_TEXTURE_SIZE = int(os.environ.get("DICOM_VIEWER_MAX_TEXTURE", "2048"))
+# ピラミッドの段数（1段ごとに各軸1/2）: 等倍, 2x, 4x, 8x
+PYRAMID_STEPS = 3
+# 回転・クリッピング中に表示する段（4x縮小）
+PREVIEW_STEP = 2
+# 操作が止まってから高解像度に戻すまでの時間
+IDLE_MS = 300
+
+@dataclass
+class PyramidLevel:
+    data: np.ndarray
+    # 元ボリュームに対する各軸 (z, y, x) の縮小率
+    factors: tuple[int, int, int]
+
+    def scale(self, spacing: list[float]) -> list[float]:
+        return [s * f for s, f in zip(spacing, self.factors)]
+
+    def translate(self, spacing: list[float]) -> list[float]:
+        # ブロックの中心が元のボクセル中心の平均位置に来るようにずらす
+        return [s * (f - 1) / 2 for s, f in zip(spacing, self.factors)]
+
+    def to_level(self, pos) -> tuple[float, float, float]:
+        """元ボリュームのボクセル座標を、この段のボクセル座標へ変換"""
+        return tuple((p - (f - 1) / 2) / f for p, f in zip(pos, self.factors))
+
+    def crop(self, box) -> tuple[np.ndarray, tuple[int, int, int]]:
+        """
+        元ボリュームのボクセル範囲 box ((z0, z1), (y0, y1), (x0, x1)) を覆うこの段の部分配列と、その先頭の番号。
+        メモリ上の段は連続したコピーにする（非連続のビューはnapariが転送前に結局コピーする）
+        """
+        start = tuple(int(lo) // f for (lo, _), f in zip(box, self.factors))
+        stop = tuple(min(-(-int(hi) // f), n) for (_, hi), f, n in zip(box, self.factors, self.data.shape))
+        sub = self.data[tuple(slice(a, b) for a, b in zip(start, stop))]
+        return (np.ascontiguousarray(sub) if isinstance(sub, np.ndarray) else sub), start
+
+def block_mean(volume, factors: tuple[int, int, int]) -> np.ndarray:
+    """各軸 factors 個ずつのブロック平均で縮小する（割り切れない端は切り捨て）"""
+    fz, fy, fx = factors
+    if not isinstance(volume, np.ndarray):
+        # daskなど遅延配列: 縮小後は小さいのでここで実体化してしまう
+        import dask.array as da
+        out = da.coarsen(np.mean, volume, {0: fz, 1: fy, 2: fx}, trim_excess=True)
+        return np.asarray(out.compute()).astype(volume.dtype)
+
+    z, y, x = volume.shape[0] // fz, volume.shape[1] // fy, volume.shape[2] // fx
+    blocks = volume[:z * fz, :y * fy, :x * fx].reshape(z, fz, y, fy, x, fx)
+    out = blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+    if np.issubdtype(volume.dtype, np.integer):
+        np.rint(out, out=out)
+    return out.astype(volume.dtype)
+
+def build_pyramid(volume, steps: int = PYRAMID_STEPS) -> list[PyramidLevel]:
+    """等倍から 2^steps 倍縮小までのピラミッドを、1つ前の段から順に作る"""
+    levels = [PyramidLevel(volume, (1, 1, 1))]
+    for _ in range(steps):
+        prev = levels[-1]
+        # 2枚未満しかない軸はそれ以上縮めない
+        step = tuple(2 if n >= 2 else 1 for n in prev.data.shape)
+        if step == (1, 1, 1): break
+        factors = tuple(f * s for f, s in zip(prev.factors, step))
+        levels.append(PyramidLevel(block_mean(prev.data, step), factors))
+    return levels
+
+def get_pyramid(data) -> list[PyramidLevel]:
+    """系列ごとに1回だけピラミッドを作り、data.derived に保持する"""
+    if "pyramid" not in data.derived:
+        data.derived["pyramid"] = build_pyramid(data.volume)
+    return data.derived["pyramid"]
+
+def pick_level(levels: list[PyramidLevel], max_texture_size: int) -> int:
+    """一辺が max_texture_size に収まる最も高解像度の段の番号"""
+    for i, level in enumerate(levels):
+        if max(level.data.shape) <= max_texture_size:
+            return i
+    return len(levels) - 1
+
+class InteractiveLOD:
+    """
+    1枚のImageレイヤーに表示する段を切り替える。
+    操作中は粗い段を表示し、IDLE_MS 操作が無ければ上限内で最も細かい段に戻す。
+    （napariは3D表示のマルチスケール画像で最も粗い段しか描かないため、段の差し替えで実現する）
+    """
+    def __init__(self, levels: list[PyramidLevel], spacing: list[float],
+                 max_texture_size: int = MAX_TEXTURE_SIZE, on_level_change=None):
+        self.levels = levels
+        self.spacing = spacing
+        self.full = pick_level(levels, max_texture_size)
+        self.preview = max(self.full, min(PREVIEW_STEP, len(levels) - 1))
+        self.current = self.full
+        self.layer = None
+        # 切り出す範囲（元ボリュームのボクセル範囲。None は全体）。操作中は切り出さず全体を表示する
+        self.crop = None
+        self.interacting = False
+        # 表示中のデータの先頭が、表示中の段の何番目のボクセルか（クリッピング面の座標に使う）
+        self.origin = (0, 0, 0)
+        # 表示中の (段, 切り出し範囲)。同じなら転送し直さない
+        self._shown = (self.current, None)
+        # 段が変わった後に呼ばれる（クリッピング面の座標の付け直しなど）
+        self.on_level_change = on_level_change
+
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(IDLE_MS)
+        self._timer.timeout.connect(self._on_idle)
+
+    @property
+    def level(self) -> PyramidLevel:
+        return self.levels[self.current]
+
+    def layer_kwargs(self) -> dict:
+        """add_image に渡す data / scale / translate"""
+        return {
+            "data": self.level.data,
+            "scale": self.level.scale(self.spacing),
+            "translate": self.level.translate(self.spacing),
+        }
+
+    def attach(self, layer):
+        self.layer = layer
+
+    def interact(self, event=None):
+        """操作があったことを通知する。粗い段に切り替えてアイドルタイマーを延長"""
+        if self.layer is None: return
+        self.interacting = True
+        self.set_level(self.preview)
+        self._timer.start()
+
+    def _on_idle(self):
+        self.interacting = False
+        self.set_level(self.full)
+
+    def set_crop(self, box):
+        """切り出す範囲を変える。操作中なら反映は操作が止まってから"""
+        self.crop = box
+        if not self.interacting:
+            self.set_level(self.current)
+
+    @instrument("lod.set_level")
+    def set_level(self, idx: int):
+        if self.layer is None: return
+        box = None if self.interacting else self.crop
+        if (idx, box) == self._shown: return
+        self.current = idx
+        self._shown = (idx, box)
+        level = self.level
+        if box is not None:
+            data, self.origin = level.crop(box)
+        else:
+            data, self.origin = level.data, (0, 0, 0)
+        scale = level.scale(self.spacing)
+        self.layer.data = data
+        self.layer.scale = scale
+        self.layer.translate = [t + o * s for t, o, s in zip(level.translate(self.spacing), self.origin, scale)]
+        if self.on_level_change:
+            self.on_level_change()
+
+    def stop(self):
+        """タイマーを止めて最も細かい段に戻す（モード切替時など）"""
+        self._timer.stop()
+        self.interacting = False
+        self.set_level(self.full)
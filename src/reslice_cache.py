@@ -0,0 +1,66 @@
+import threading
+import numpy as np
+
+# 転置コピーを作ってもこの割合以上の空きメモリが残る場合だけ有効にする
+MEMORY_HEADROOM = 0.5
+
+def memory_allows(nbytes: int) -> bool:
+    """nbytes を追加で確保しても空きメモリに余裕があるか。psutilが無ければ判断せず無効"""
+    try:
+        import psutil
+    except ImportError:
+        return False
+    return nbytes <= psutil.virtual_memory().available * (1 - MEMORY_HEADROOM)
+
+class ResliceCache:
+    """
+    Coronal / Sagittal 断面を連続したメモリから取り出すための転置コピー。
+    vol[:, y, :] や vol[:, :, x] はストライドの大きい非連続ビューで、napariが転送前に毎回コピーするため遅い。
+    コピーはバックグラウンドで作り、完成するまでは元のボリュームから切り出す
+    """
+    def __init__(self, volume: np.ndarray):
+        self.volume = volume
+        # coronal: (y, z, x)、sagittal: (x, z, y) の C連続配列
+        self._coronal = None
+        self._sagittal = None
+        self._thread = threading.Thread(target=self._build, daemon=True)
+        self._thread.start()
+
+    def _build(self):
+        self._coronal = np.ascontiguousarray(self.volume.transpose(1, 0, 2))
+        self._sagittal = np.ascontiguousarray(self.volume.transpose(2, 0, 1))
+
+    @property
+    def ready(self) -> bool:
+        return self._sagittal is not None
+
+    def coronal(self, y: int) -> np.ndarray:
+        if self._coronal is not None:
+            return self._coronal[y]
+        return self.volume[:, y, :]
+
+    def sagittal(self, x: int) -> np.ndarray:
+        if self._sagittal is not None:
+            return self._sagittal[x]
+        return self.volume[:, :, x]
+
+    def planes(self, axis: int, start: int, stop: int) -> np.ndarray:
+        """axis 方向の start:stop 枚を、断面の並び (枚数, 行, 列) で返す（各断面は coronal / sagittal と同じ向き）"""
+        if axis == 0:
+            return self.volume[start:stop]
+        if axis == 1:
+            return self._coronal[start:stop] if self._coronal is not None else self.volume[:, start:stop, :].transpose(1, 0, 2)
+        return self._sagittal[start:stop] if self._sagittal is not None else self.volume[:, :, start:stop].transpose(2, 0, 1)
+
+def get_reslice_cache(data) -> ResliceCache | None:
+    """
+    読み込みが完了したメモリ上のボリュームで、空きメモリが足りる場合だけキャッシュを作る。
+    使えない場合は None（呼び出し側で元のボリュームから切り出す）
+    """
+    if "reslice" not in data.derived:
+        vol = data.volume
+        # 遅延配列（dask）は全スライスをデコードすることになるので対象外
+        if data.loading or not isinstance(vol, np.ndarray):
+            return None
+        data.derived["reslice"] = ResliceCache(vol) if memory_allows(2 * vol.nbytes) else None
+    return data.derived["reslice"]
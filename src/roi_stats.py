@@ -0,0 +1,221 @@
+import threading
+import numpy as np
+from dataclasses import dataclass
+
+from reslice_cache import memory_allows
+from profiling import instrument
+
+# ヒストグラムのビン数
+HIST_BINS = 64
+# 表示用のヒストグラム（文字で描く）のビン数と文字
+SPARK_BINS = 16
+SPARK_CHARS = " ▁▂▃▄▅▆▇█"
+# 回転した楕円を近似する多角形の頂点数
+ELLIPSE_POINTS = 64
+
+@dataclass
+class RoiStats:
+    count: int
+    mean: float
+    std: float
+    # min / max / ヒストグラムは領域の値を直接見る（省いた場合は None）
+    min: float | None
+    max: float | None
+    # 面積 (mm²) または体積 (mm³)
+    size: float
+    unit: str
+    hist: np.ndarray | None = None
+    edges: np.ndarray | None = None
+
+    def summary(self) -> str:
+        lines = [
+            f"Mean: {self.mean:.1f}  SD: {self.std:.1f}",
+            f"Min: {self.min:.0f}  Max: {self.max:.0f}" if self.min is not None else "Min / Max: ...",
+            f"{'Area' if self.unit == 'mm²' else 'Volume'}: {self.size:.1f} {self.unit}  ({self.count} px)",
+        ]
+        if self.hist is not None and self.hist.size:
+            # HIST_BINS を SPARK_BINS にまとめて1行で描く
+            counts = self.hist.reshape(SPARK_BINS, -1).sum(axis=1) if self.hist.size % SPARK_BINS == 0 else self.hist
+            levels = np.ceil(counts / max(counts.max(), 1) * (len(SPARK_CHARS) - 1)).astype(int)
+            lines.append("Hist: " + "".join(SPARK_CHARS[i] for i in levels))
+        return "\n".join(lines)
+
+def values_stats(values: np.ndarray, unit_size: float, unit: str) -> RoiStats | None:
+    """領域の値から統計を直接計算する"""
+    if values.size == 0: return None
+    v = values.astype(np.float64, copy=False)
+    lo, hi = float(v.min()), float(v.max())
+    hist, edges = np.histogram(v, bins=HIST_BINS, range=(lo, hi if hi > lo else lo + 1))
+    return RoiStats(int(v.size), float(v.mean()), float(v.std()), lo, hi, v.size * unit_size, unit, hist, edges)
+
+class SummedAreaTable:
+    """
+    値と値の2乗の3次元の累積和（先頭に0の面を足したもの）。
+    任意の直方体の和が8点の参照で求まるので、矩形ROI・ボックスROIの平均と標準偏差はROIの大きさに依らない。
+    作成はバックグラウンドで行い、完成するまでは None を返す（呼び出し側で直接計算する）
+    """
+    def __init__(self, volume: np.ndarray):
+        self.volume = volume
+        self.dtype = np.dtype(np.int64 if np.issubdtype(volume.dtype, np.integer) else np.float64)
+        self._sums = None
+        self._squares = None
+        self._thread = threading.Thread(target=self._build, daemon=True)
+        self._thread.start()
+
+    @property
+    def ready(self) -> bool:
+        return self._squares is not None
+
+    def _build(self):
+        nz, ny, nx = self.volume.shape
+        sums = np.zeros((nz + 1, ny + 1, nx + 1), dtype=self.dtype)
+        squares = np.zeros_like(sums)
+        # 1枚ずつ書き込み、ボリューム全体の一時配列を作らない
+        for z in range(nz):
+            plane = self.volume[z].astype(self.dtype)
+            sums[z + 1, 1:, 1:] = plane
+            np.multiply(plane, plane, out=squares[z + 1, 1:, 1:])
+        for table in (sums, squares):
+            for axis in range(3):
+                np.cumsum(table, axis=axis, out=table)
+        self._sums = sums
+        self._squares = squares
+
+    def _box(self, table: np.ndarray, box) -> float:
+        (z0, z1), (y0, y1), (x0, x1) = box
+        return float(
+            table[z1, y1, x1] - table[z0, y1, x1] - table[z1, y0, x1] - table[z1, y1, x0]
+            + table[z0, y0, x1] + table[z0, y1, x0] + table[z1, y0, x0] - table[z0, y0, x0]
+        )
+
+    def box_moments(self, box) -> tuple[int, float, float] | None:
+        """直方体 ((z0, z1), (y0, y1), (x0, x1)) の (画素数, 和, 2乗和)。未完成なら None"""
+        if not self.ready: return None
+        count = int(np.prod([hi - lo for lo, hi in box]))
+        return count, self._box(self._sums, box), self._box(self._squares, box)
+
+def get_sat(data) -> SummedAreaTable | None:
+    """
+    読み込みが完了したメモリ上のボリュームで、空きメモリが足りる場合だけ系列ごとに1回作る。
+    使えない場合は None（統計は領域の値から直接計算する）
+    """
+    if "sat" not in data.derived:
+        vol = data.volume
+        if data.loading or not isinstance(vol, np.ndarray):
+            return None
+        nbytes = 2 * 8 * (vol.shape[0] + 1) * (vol.shape[1] + 1) * (vol.shape[2] + 1)
+        data.derived["sat"] = SummedAreaTable(vol) if memory_allows(nbytes) else None
+    return data.derived["sat"]
+
+def clip_box(box, shape) -> tuple | None:
+    """直方体をボリューム内に収める。空になれば None"""
+    out = tuple((max(int(lo), 0), min(int(hi), n)) for (lo, hi), n in zip(box, shape))
+    if any(lo >= hi for lo, hi in out): return None
+    return out
+
+@instrument("roi.box")
+def box_stats(data, box, extremes: bool = True, plane_axis: int | None = None) -> RoiStats | None:
+    """
+    直方体の統計。平均・標準偏差は累積和から O(1)（未完成なら直接）。
+    extremes=False なら min / max / ヒストグラムを省く（ドラッグ中のボックスROI用）。
+    plane_axis を指定すると、その軸の1枚の断面上の矩形として面積で表す
+    """
+    box = clip_box(box, data.volume.shape)
+    if box is None: return None
+    sp = data.voxel_spacing
+    if plane_axis is not None:
+        unit_size, unit = float(np.prod([s for i, s in enumerate(sp) if i != plane_axis])), "mm²"
+    else:
+        unit_size, unit = float(np.prod(sp)), "mm³"
+
+    sat = get_sat(data)
+    moments = sat.box_moments(box) if sat is not None else None
+    if moments is None:
+        if not extremes:
+            region = np.asarray(data.volume[tuple(slice(lo, hi) for lo, hi in box)], dtype=np.float64)
+            moments = region.size, float(region.sum()), float(np.square(region).sum())
+        else:
+            return values_stats(np.asarray(data.volume[tuple(slice(lo, hi) for lo, hi in box)]), unit_size, unit)
+
+    count, total, squares = moments
+    mean = total / count
+    std = float(np.sqrt(max(squares / count - mean * mean, 0.0)))
+    stats = RoiStats(count, mean, std, None, None, count * unit_size, unit)
+    if extremes:
+        # min / max / ヒストグラムは累積和では求まらないので領域を直接見る
+        region = np.asarray(data.volume[tuple(slice(lo, hi) for lo, hi in box)])
+        stats.min, stats.max = float(region.min()), float(region.max())
+        stats.hist, stats.edges = np.histogram(region, bins=HIST_BINS, range=(stats.min, max(stats.max, stats.min + 1)))
+    return stats
+
+def polygon_mask(vertices: np.ndarray, shape: tuple[int, int]) -> np.ndarray:
+    """
+    多角形 (行, 列) の内側にある画素中心のマスク（偶奇規則）。
+    行ごとに各辺との交点を求め、交点の右側の画素の反転回数を累積して塗る（画素ごとの判定はしない）
+    """
+    rows, cols = shape
+    mask = np.zeros(shape, dtype=bool)
+    if len(vertices) < 3 or rows == 0 or cols == 0: return mask
+    r0, c0 = vertices[:, 0], vertices[:, 1]
+    r1, c1 = np.roll(r0, -1), np.roll(c0, -1)
+    y = np.arange(rows, dtype=np.float64)[:, None]
+    # 半開区間で判定し、頂点を2回数えない
+    crosses = (r0 <= y) != (r1 <= y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = c0 + (y - r0) * (c1 - c0) / (r1 - r0)
+    row_idx, edge_idx = np.nonzero(crosses)
+    start = np.clip(np.ceil(x[row_idx, edge_idx]), 0, cols).astype(np.intp)
+    toggles = np.zeros((rows, cols + 1), dtype=np.int32)
+    np.add.at(toggles, (row_idx, start), 1)
+    mask[:] = (np.cumsum(toggles[:, :cols], axis=1) & 1).astype(bool)
+    return mask
+
+def ellipse_mask(center: tuple[float, float], radii: tuple[float, float], shape: tuple[int, int]) -> np.ndarray:
+    """軸に沿った楕円の内側にある画素中心のマスク"""
+    r, c = np.ogrid[:shape[0], :shape[1]]
+    ry, rx = max(radii[0], 1e-6), max(radii[1], 1e-6)
+    return ((r - center[0]) / ry) ** 2 + ((c - center[1]) / rx) ** 2 <= 1
+
+def _is_axis_aligned(vertices: np.ndarray) -> bool:
+    return len(vertices) == 4 and len(np.unique(vertices[:, 0])) <= 2 and len(np.unique(vertices[:, 1])) <= 2
+
+@instrument("roi.shape")
+def shape_stats(data, axis: int, index: int, shape_type: str, vertices: np.ndarray) -> RoiStats | None:
+    """
+    断面（axis 方向の index 枚目）上の図形の統計。vertices はその断面の (行, 列) 画素座標。
+    回転していない矩形は直方体として累積和を使い、楕円・多角形は外接矩形の中だけでマスクを作る
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    row_axis, col_axis = [a for a in range(3) if a != axis]
+    # 断面の画素中心のうち、図形の外接矩形に入る範囲
+    lo = np.ceil(vertices.min(axis=0)).astype(int)
+    hi = np.floor(vertices.max(axis=0)).astype(int) + 1
+    box = [None, None, None]
+    box[axis] = (index, index + 1)
+    box[row_axis] = (lo[0], hi[0])
+    box[col_axis] = (lo[1], hi[1])
+
+    if shape_type == "rectangle" and _is_axis_aligned(vertices):
+        return box_stats(data, box, plane_axis=axis)
+
+    box = clip_box(box, data.volume.shape)
+    if box is None: return None
+    region = np.asarray(data.volume[tuple(slice(a, b) for a, b in box)])
+    # 断面の向き (行, 列) にする（行は番号の小さい軸。2Dビューの向きと同じ）
+    region = np.moveaxis(region, axis, 0)[0]
+    origin = np.array([box[row_axis][0], box[col_axis][0]], dtype=np.float64)
+    local = vertices - origin
+    if shape_type == "ellipse" and _is_axis_aligned(local):
+        center = (local.min(axis=0) + local.max(axis=0)) / 2
+        radii = (local.max(axis=0) - local.min(axis=0)) / 2
+        mask = ellipse_mask(center, radii, region.shape)
+    elif shape_type == "ellipse":
+        # 回転した楕円（頂点は外接矩形の4隅）は多角形で近似する
+        t = np.linspace(0, 2 * np.pi, ELLIPSE_POINTS, endpoint=False)[:, None]
+        center = local.mean(axis=0)
+        a, b = (local[1] - local[0]) / 2, (local[3] - local[0]) / 2
+        mask = polygon_mask(center + a * np.cos(t) + b * np.sin(t), region.shape)
+    else:
+        mask = polygon_mask(local, region.shape)
+    sp = data.voxel_spacing
+    return values_stats(region[mask], sp[row_axis] * sp[col_axis], "mm²")
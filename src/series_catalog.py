@@ -0,0 +1,195 @@
+import os
+import sqlite3
+import pydicom
+from pathlib import Path
+from contextlib import contextmanager
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from pydicom.errors import InvalidDicomError
+
+# カタログの保存先（環境変数で変更可）
+CATALOG_PATH = Path(os.environ.get("DICOM_VIEWER_CATALOG", Path.home() / ".dicom_viewer" / "catalog.sqlite3"))
+
+# 索引に必要なタグだけを読む（ピクセルデータ・プライベートタグは読まない）
+INDEX_TAGS = [
+    "StudyInstanceUID", "SeriesInstanceUID", "PatientID", "PatientName", "Modality",
+    "StudyDate", "SeriesDescription", "SeriesNumber", "InstanceNumber", "Rows",
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    -- DICOM画像でないファイルは NULL（次回のスキャンで読み直さないために記録だけする）
+    series_uid TEXT,
+    instance_number INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_files_series ON files(series_uid);
+
+CREATE TABLE IF NOT EXISTS series (
+    series_uid TEXT PRIMARY KEY,
+    study_uid TEXT,
+    patient_id TEXT,
+    patient_name TEXT,
+    modality TEXT,
+    study_date TEXT,
+    series_description TEXT,
+    series_number INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_series_patient ON series(patient_id);
+CREATE INDEX IF NOT EXISTS idx_series_study ON series(study_uid);
+CREATE INDEX IF NOT EXISTS idx_series_modality ON series(modality);
+CREATE INDEX IF NOT EXISTS idx_series_date ON series(study_date);
+"""
+
+@dataclass
+class SeriesInfo:
+    series_uid: str
+    study_uid: str
+    patient_id: str
+    patient_name: str
+    modality: str
+    study_date: str
+    series_description: str
+    series_number: int | None
+    file_count: int
+
+    @property
+    def label(self) -> str:
+        """シリーズ選択欄に出す表示名"""
+        number = f"#{self.series_number} " if self.series_number is not None else ""
+        return (f"{number}{self.modality} {self.series_description or 'No Description'} "
+                f"({self.file_count} files, {self.patient_id}, {self.study_date})")
+
+# 読めなかったファイルを表す _index_header の戻り値（DICOM画像でないファイルの None と区別して数える）
+_SKIPPED = object()
+
+def _index_header(path: str):
+    """索引用にヘッダの一部だけを読む。DICOM画像でなければ None、壊れていれば _SKIPPED"""
+    try:
+        dcm = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=INDEX_TAGS)
+    except InvalidDicomError:
+        return None
+    except Exception:
+        # ファイルごとには出力せず、件数を SeriesCatalog.skipped にまとめる
+        return _SKIPPED
+    if "SeriesInstanceUID" not in dcm or "Rows" not in dcm:
+        return None
+    return dcm
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+class SeriesCatalog:
+    """
+    フォルダ以下を再帰的に走査し、Study/Series UIDでまとめたヘッダ情報をSQLiteに保存する。
+    再スキャン時は更新時刻とサイズが変わったファイルだけを読み直す
+    """
+    def __init__(self, db_path: Path = CATALOG_PATH):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # 直近の index_folder で読めずに飛ばしたファイルの数
+        self.skipped = 0
+        with self._connect() as con:
+            con.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # ワーカースレッドからも使うので、呼び出しごとに接続を開いて閉じる
+        con = sqlite3.connect(self.db_path)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def index_folder(self, folder: str, max_workers: int | None = None) -> list[SeriesInfo]:
+        """folder 以下を索引に反映し、そこに含まれるシリーズの一覧を返す"""
+        root = Path(folder).resolve()
+        if not root.is_dir():
+            raise ValueError("フォルダが見つかりません")
+
+        on_disk = {}
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                p = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                on_disk[p] = (st.st_mtime_ns, st.st_size)
+
+        prefix = str(root) + os.sep
+        with self._connect() as con:
+            known = {
+                path: (mtime, size)
+                for path, mtime, size in con.execute(
+                    "SELECT path, mtime_ns, size FROM files WHERE substr(path, 1, ?) = ?",
+                    (len(prefix), prefix),
+                )
+            }
+
+        # 消えたファイルは索引から外し、新規・変更ファイルだけヘッダを読む
+        removed = [p for p in known if p not in on_disk]
+        changed = [p for p, stat in on_disk.items() if known.get(p) != stat]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            headers = list(pool.map(_index_header, changed))
+        self.skipped = sum(dcm is _SKIPPED for dcm in headers)
+
+        with self._connect() as con:
+            con.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in removed])
+            for p, dcm in zip(changed, headers):
+                mtime, size = on_disk[p]
+                if dcm is None or dcm is _SKIPPED:
+                    con.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, NULL, NULL)", (p, mtime, size))
+                    continue
+                series_uid = str(dcm.SeriesInstanceUID)
+                con.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                    (p, mtime, size, series_uid, _int_or_none(dcm.get("InstanceNumber"))),
+                )
+                con.execute(
+                    "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        series_uid,
+                        str(dcm.get("StudyInstanceUID", "")),
+                        str(dcm.get("PatientID", "")),
+                        str(dcm.get("PatientName", "")),
+                        str(dcm.get("Modality", "")),
+                        str(dcm.get("StudyDate", "")),
+                        str(dcm.get("SeriesDescription", "")),
+                        _int_or_none(dcm.get("SeriesNumber")),
+                    ),
+                )
+
+        return self.list_series(str(root))
+
+    def list_series(self, folder: str | None = None) -> list[SeriesInfo]:
+        """索引済みのシリーズ一覧。folder を指定するとその配下のファイルを持つものに限る"""
+        sql = (
+            "SELECT s.*, COUNT(f.path) FROM series s JOIN files f ON f.series_uid = s.series_uid"
+        )
+        params = ()
+        if folder is not None:
+            prefix = str(Path(folder).resolve()) + os.sep
+            sql += " WHERE substr(f.path, 1, ?) = ?"
+            params = (len(prefix), prefix)
+        sql += " GROUP BY s.series_uid ORDER BY s.patient_id, s.study_date, s.study_uid, s.series_number"
+        with self._connect() as con:
+            return [SeriesInfo(*row) for row in con.execute(sql, params)]
+
+    def series_files(self, series_uid: str, folder: str | None = None) -> list[Path]:
+        """シリーズに属するファイルのパス。folder を指定するとその配下に限る"""
+        sql = "SELECT path FROM files WHERE series_uid = ?"
+        params = (series_uid,)
+        if folder is not None:
+            prefix = str(Path(folder).resolve()) + os.sep
+            sql += " AND substr(path, 1, ?) = ?"
+            params += (len(prefix), prefix)
+        with self._connect() as con:
+            return [Path(path) for (path,) in con.execute(sql + " ORDER BY path", params)]
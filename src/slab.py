@@ -0,0 +1,126 @@
+import threading
+import numpy as np
+
+from reslice_cache import ResliceCache, get_reslice_cache, memory_allows
+from profiling import instrument
+
+# 投影の種類
+SLAB_MODES = ("MIP", "MinIP", "Average")
+# 最大値・最小値を前計算するブロックの枚数
+SLAB_BLOCK = 8
+
+def slab_range(center: int, thickness_mm: float, spacing: float, n: int) -> tuple[int, int]:
+    """center を中心とする厚さ thickness_mm の範囲 [start, stop)（1枚以上、ボリューム内に収める）"""
+    count = max(1, int(round(thickness_mm / spacing)))
+    start = int(np.clip(center - count // 2, 0, max(n - count, 0)))
+    return start, min(start + count, n)
+
+def accumulator_dtype(volume: np.ndarray) -> np.dtype:
+    """累積和の型。全枚数を足しても溢れない整数なら int32、だめなら int64、実数は float64"""
+    if not np.issubdtype(volume.dtype, np.integer):
+        return np.dtype(np.float64)
+    info = np.iinfo(volume.dtype)
+    peak = max(abs(int(info.min)), abs(int(info.max))) * max(volume.shape)
+    return np.dtype(np.int32 if peak < np.iinfo(np.int32).max else np.int64)
+
+def project(planes: np.ndarray, mode: str) -> np.ndarray:
+    """断面の並び (枚数, 行, 列) を1枚に投影する（前計算が無い場合）"""
+    if mode == "MIP":
+        return planes.max(axis=0)
+    if mode == "MinIP":
+        return planes.min(axis=0)
+    return planes.mean(axis=0, dtype=np.float32)
+
+class SlabIndex:
+    """
+    厚みのある投影 (MIP / MinIP / Average) を、スライス位置を動かすたびに全枚数を読み直さずに作るための前計算。
+    軸ごとに
+      - 累積和 S（Average は (S[stop] - S[start]) / 枚数 の1回の引き算）
+      - SLAB_BLOCK 枚ごとの最大値・最小値（MIP / MinIP は両端の端数の断面と、間のブロックだけを見る）
+    をバックグラウンドで作る。完成するまでと、累積和を置く空きメモリが無い場合は断面から直接計算する
+    """
+    def __init__(self, volume: np.ndarray, reslice: ResliceCache | None):
+        self.volume = volume
+        # Coronal / Sagittal の断面は転置コピーがあればそこから取る
+        self.reslice = reslice
+        self._sums: dict[int, np.ndarray] = {}
+        self._max: dict[int, np.ndarray] = {}
+        self._min: dict[int, np.ndarray] = {}
+        self.dtype = accumulator_dtype(volume)
+        # 3軸分の累積和（各軸 ボリュームの要素数 + 1断面）が入るか
+        self.with_sums = memory_allows(3 * volume.size * self.dtype.itemsize)
+        self._thread = threading.Thread(target=self._build, daemon=True)
+        self._thread.start()
+
+    def _planes(self, axis: int, start: int, stop: int) -> np.ndarray:
+        if self.reslice is not None:
+            return self.reslice.planes(axis, start, stop)
+        return np.moveaxis(self.volume, axis, 0)[start:stop]
+
+    @property
+    def ready(self) -> bool:
+        return not self._thread.is_alive()
+
+    def _build(self):
+        for axis in range(3):
+            self._build_blocks(axis)
+        if not self.with_sums: return
+        for axis in range(3):
+            self._build_sums(axis)
+
+    def _build_blocks(self, axis: int):
+        n = self.volume.shape[axis]
+        count = n // SLAB_BLOCK
+        if count < 2: return
+        first = self._planes(axis, 0, 1)[0]
+        block_max = np.empty((count,) + first.shape, dtype=self.volume.dtype)
+        block_min = np.empty_like(block_max)
+        for k in range(count):
+            planes = self._planes(axis, k * SLAB_BLOCK, (k + 1) * SLAB_BLOCK)
+            planes.max(axis=0, out=block_max[k])
+            planes.min(axis=0, out=block_min[k])
+        self._max[axis], self._min[axis] = block_max, block_min
+
+    def _build_sums(self, axis: int):
+        n = self.volume.shape[axis]
+        first = self._planes(axis, 0, 1)[0]
+        sums = np.empty((n + 1,) + first.shape, dtype=self.dtype)
+        sums[0] = 0
+        for i in range(n):
+            np.add(sums[i], self._planes(axis, i, i + 1)[0], out=sums[i + 1])
+        self._sums[axis] = sums
+
+    @instrument("slab.project")
+    def project(self, axis: int, start: int, stop: int, mode: str) -> np.ndarray:
+        """axis 方向の start:stop 枚を mode で投影した断面（向きは通常の断面と同じ）"""
+        if mode == "Average":
+            sums = self._sums.get(axis)
+            if sums is None:
+                return project(self._planes(axis, start, stop), mode)
+            out = (sums[stop] - sums[start]).astype(np.float32)
+            out /= stop - start
+            return out
+
+        blocks = (self._max if mode == "MIP" else self._min).get(axis)
+        # ブロックを丸ごと含む範囲 [b0, b1)（ブロック番号）
+        b0, b1 = -(-start // SLAB_BLOCK), stop // SLAB_BLOCK
+        if blocks is None or b0 >= b1:
+            return project(self._planes(axis, start, stop), mode)
+        reduce = np.maximum if mode == "MIP" else np.minimum
+        out = project(blocks[b0:b1], mode)
+        for lo, hi in ((start, b0 * SLAB_BLOCK), (b1 * SLAB_BLOCK, stop)):
+            if lo < hi:
+                reduce(out, project(self._planes(axis, lo, hi), mode), out=out)
+        return out
+
+def get_slab_index(data) -> SlabIndex | None:
+    """
+    読み込みが完了したメモリ上のボリュームで、系列ごとに1回だけ作る。
+    遅延配列（dask）は前計算で全スライスをデコードすることになるので対象外（None）
+    """
+    if "slab" not in data.derived:
+        vol = data.volume
+        if data.loading or not isinstance(vol, np.ndarray):
+            return None
+        data.derived["slab"] = SlabIndex(vol, get_reslice_cache(data))
+    return data.derived["slab"]
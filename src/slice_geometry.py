@@ -0,0 +1,77 @@
+import numpy as np
+from dataclasses import dataclass, field
+
+# 同じ位置とみなす距離 (mm)
+DUPLICATE_TOLERANCE = 1e-3
+# 間隔の中央値からこの割合以上ずれたら不等間隔とみなす
+SPACING_TOLERANCE = 0.01
+
+@dataclass
+class SliceGeometry:
+    """ImagePositionPatient / ImageOrientationPatient から求めたスライスの並びと間隔"""
+    # ファイル順 -> 並べ替え後の順 の添字
+    order: np.ndarray
+    # 並べ替え後の各スライスの法線方向の位置 (mm)
+    positions: np.ndarray
+    # スライス間隔の中央値 (mm)。1枚しかない・位置が取れない場合は None
+    spacing: float | None
+    # 間隔が中央値から SPACING_TOLERANCE 以上ずれている箇所がある
+    nonuniform: bool = False
+    # 直前のスライスと同じ位置にある（並べ替え後の）スライス番号
+    duplicates: list[int] = field(default_factory=list)
+    # 方向 (ImageOrientationPatient) が揃っていない
+    mixed_orientation: bool = False
+
+    @property
+    def warnings(self) -> list[str]:
+        messages = []
+        if self.duplicates:
+            messages.append(f"{len(self.duplicates)} duplicate slice positions")
+        if self.nonuniform:
+            diffs = np.abs(np.diff(self.positions))
+            diffs = diffs[diffs > DUPLICATE_TOLERANCE]
+            messages.append(f"Non-uniform spacing ({diffs.min():.3g}-{diffs.max():.3g} mm)")
+        if self.mixed_orientation:
+            messages.append("Mixed slice orientations")
+        return messages
+
+def compute_geometry(positions, orientations) -> SliceGeometry:
+    """
+    全スライスの ImagePositionPatient (n, 3) と ImageOrientationPatient (n, 6) から、
+    法線への射影で並び順・間隔・重複をまとめて求める。
+    並びは法線方向の降順（通常のAxialなら頭側が先頭）
+    """
+    ipp = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    iop = np.asarray(orientations, dtype=np.float64).reshape(-1, 6)
+
+    normal = np.cross(iop[0, :3], iop[0, 3:])
+    normal /= np.linalg.norm(normal)
+    mixed = bool(np.any(np.abs(iop - iop[0]) > 1e-4))
+
+    dist = ipp @ normal
+    # 同じ位置のスライス同士は元の（ファイル）順を保つ
+    order = np.argsort(-dist, kind="stable")
+    dist = dist[order]
+
+    gaps = np.abs(np.diff(dist))
+    dup = gaps <= DUPLICATE_TOLERANCE
+    steps = gaps[~dup]
+    if steps.size == 0:
+        return SliceGeometry(order, dist, None, duplicates=(np.flatnonzero(dup) + 1).tolist(),
+                             mixed_orientation=mixed)
+
+    spacing = float(np.median(steps))
+    nonuniform = bool(np.any(np.abs(steps - spacing) > SPACING_TOLERANCE * spacing))
+    return SliceGeometry(order, dist, spacing, nonuniform=nonuniform,
+                         duplicates=(np.flatnonzero(dup) + 1).tolist(), mixed_orientation=mixed)
+
+def geometry_from_headers(headers: list) -> SliceGeometry | None:
+    """ヘッダの一覧から SliceGeometry を作る。位置・方向が揃っていない系列は None"""
+    try:
+        positions = [dcm.ImagePositionPatient for dcm in headers]
+        orientations = [dcm.ImageOrientationPatient for dcm in headers]
+    except AttributeError:
+        return None
+    if any(len(p) != 3 for p in positions) or any(len(o) != 6 for o in orientations):
+        return None
+    return compute_geometry(positions, orientations)
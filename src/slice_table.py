@@ -0,0 +1,108 @@
+import numpy as np
+from dataclasses import dataclass
+
+def _float(dcm, keyword: str, default=np.nan) -> float:
+    value = dcm.get(keyword)
+    if value is None or value == "":
+        return default
+    if not isinstance(value, (int, float, str)):
+        # WindowCenter などの多値は先頭を使う
+        value = value[0]
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+def _seconds(tm) -> float:
+    """DICOMのTM (HHMMSS.ffffff) を0時からの秒数にする"""
+    text = str(tm or "").replace(":", "")
+    if len(text) < 2:
+        return np.nan
+    try:
+        hours = int(text[0:2])
+        minutes = int(text[2:4]) if len(text) >= 4 else 0
+        seconds = float(text[4:]) if len(text) > 4 else 0.0
+    except ValueError:
+        return np.nan
+    return hours * 3600 + minutes * 60 + seconds
+
+@dataclass
+class SliceTable:
+    """
+    スライスごとのメタデータを列ごとの配列で持つ表（並べ替え後のスライス順）。
+    ヘッダ全体は保持せず、必要になったら paths から読み直す
+    """
+    paths: list[str]
+    # ImagePositionPatient (n, 3)。無ければ NaN
+    positions: np.ndarray
+    # InstanceNumber。無ければ -1
+    instance_numbers: np.ndarray
+    # AcquisitionTime（0時からの秒）。無ければ NaN
+    acquisition_times: np.ndarray
+    slopes: np.ndarray
+    intercepts: np.ndarray
+    window_centers: np.ndarray
+    window_widths: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    @classmethod
+    def from_headers(cls, paths: list, headers: list) -> "SliceTable":
+        positions = np.full((len(headers), 3), np.nan)
+        for i, dcm in enumerate(headers):
+            ipp = dcm.get("ImagePositionPatient")
+            if ipp is not None and len(ipp) == 3:
+                positions[i] = [float(v) for v in ipp]
+        return cls(
+            paths=[str(p) for p in paths],
+            positions=positions,
+            instance_numbers=np.array([int(_float(d, "InstanceNumber", -1)) for d in headers], dtype=np.int32),
+            acquisition_times=np.array([_seconds(d.get("AcquisitionTime")) for d in headers]),
+            slopes=np.array([_float(d, "RescaleSlope", 1.0) for d in headers]),
+            intercepts=np.array([_float(d, "RescaleIntercept", 0.0) for d in headers]),
+            window_centers=np.array([_float(d, "WindowCenter") for d in headers]),
+            window_widths=np.array([_float(d, "WindowWidth") for d in headers]),
+        )
+
+    def describe(self, i: int) -> str:
+        """サイドバーに出す i 枚目の要約"""
+        lines = [f"Slice: {i + 1} / {len(self)}"]
+        if self.instance_numbers[i] >= 0:
+            lines.append(f"Instance: {self.instance_numbers[i]}")
+        if not np.isnan(self.positions[i]).any():
+            lines.append("Position: ({:.1f}, {:.1f}, {:.1f})".format(*self.positions[i]))
+        t = self.acquisition_times[i]
+        if not np.isnan(t):
+            lines.append(f"Acq. Time: {int(t // 3600):02d}:{int(t // 60 % 60):02d}:{t % 60:06.3f}")
+        if self.slopes[i] != 1 or self.intercepts[i] != 0:
+            lines.append(f"Rescale: x{self.slopes[i]:g} {self.intercepts[i]:+g}")
+        if not np.isnan(self.window_centers[i]):
+            lines.append(f"Window: L {self.window_centers[i]:g} / W {self.window_widths[i]:g}")
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        """キャッシュ（JSON）に保存する形"""
+        return {
+            "paths": self.paths,
+            "positions": self.positions.tolist(),
+            "instance_numbers": self.instance_numbers.tolist(),
+            "acquisition_times": self.acquisition_times.tolist(),
+            "slopes": self.slopes.tolist(),
+            "intercepts": self.intercepts.tolist(),
+            "window_centers": self.window_centers.tolist(),
+            "window_widths": self.window_widths.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "SliceTable":
+        return cls(
+            paths=list(d["paths"]),
+            positions=np.array(d["positions"], dtype=np.float64).reshape(-1, 3),
+            instance_numbers=np.array(d["instance_numbers"], dtype=np.int32),
+            acquisition_times=np.array(d["acquisition_times"], dtype=np.float64),
+            slopes=np.array(d["slopes"], dtype=np.float64),
+            intercepts=np.array(d["intercepts"], dtype=np.float64),
+            window_centers=np.array(d["window_centers"], dtype=np.float64),
+            window_widths=np.array(d["window_widths"], dtype=np.float64),
+        )
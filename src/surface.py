@@ -0,0 +1,89 @@
+import time
+import numpy as np
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from pyramid import PyramidLevel, get_pyramid
+from profiling import instrument
+
+# 系列ごとに保持するメッシュの数（閾値・段の組み合わせ）
+MESH_CACHE_SIZE = 8
+# 頂点クラスタリングのセルの一辺（抽出した段のボクセル何個分か）
+CLUSTER_VOXELS = 1.5
+
+@dataclass
+class SurfaceMesh:
+    vertices: np.ndarray
+    faces: np.ndarray
+    # 抽出と間引きにかかった時間（秒）と、間引き前の面数
+    seconds: float
+    raw_faces: int
+
+    def layer_data(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """napari の Surface レイヤーに渡す (頂点, 面, 頂点の値)"""
+        return self.vertices, self.faces, np.ones(len(self.vertices), dtype=np.float32)
+
+def decimate(vertices: np.ndarray, faces: np.ndarray, cell: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    頂点クラスタリングで面を減らす。一辺 cell [mm] の格子の同じセルに入る頂点を平均の1点にまとめ、
+    つぶれた面と重複した面を捨てる
+    """
+    keys = np.floor(vertices / cell).astype(np.int64)
+    _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    merged = np.zeros((len(counts), 3), dtype=np.float64)
+    np.add.at(merged, inverse, vertices)
+    merged /= counts[:, None]
+
+    faces = inverse[faces]
+    keep = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    faces = faces[keep]
+    # 頂点の順番違いの同じ面は1つにする（向きは最初の面のものを残す）
+    _, first = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    faces = faces[np.sort(first)]
+    return merged.astype(np.float32), faces.astype(np.int32)
+
+@instrument("surface.extract")
+def extract_surface(level: PyramidLevel, spacing: list[float], threshold: float) -> SurfaceMesh:
+    """
+    段 level のボリュームから閾値 threshold の等値面を作る（頂点は元ボリュームと同じ物理座標 [mm]）。
+    閾値がボリュームの値の範囲外なら ValueError
+    """
+    from skimage.measure import marching_cubes
+
+    t0 = time.perf_counter()
+    volume = np.asarray(level.data)
+    scale = level.scale(spacing)
+    vertices, faces, _, _ = marching_cubes(volume, level=threshold, spacing=tuple(scale), allow_degenerate=False)
+    vertices += np.asarray(level.translate(spacing), dtype=vertices.dtype)
+    raw_faces = len(faces)
+    vertices, faces = decimate(vertices, faces, CLUSTER_VOXELS * min(scale))
+    return SurfaceMesh(vertices, faces, time.perf_counter() - t0, raw_faces)
+
+class MeshCache:
+    """(閾値, 段) -> メッシュ。一度作った組み合わせへの切り替えは再計算しない"""
+    def __init__(self, levels: list[PyramidLevel], spacing: list[float]):
+        self.levels = levels
+        self.spacing = spacing
+        self._meshes: OrderedDict[tuple[float, int], SurfaceMesh] = OrderedDict()
+
+    def get(self, threshold: float, level: int) -> SurfaceMesh | None:
+        key = (float(threshold), int(level))
+        mesh = self._meshes.get(key)
+        if mesh is not None:
+            self._meshes.move_to_end(key)
+        return mesh
+
+    def build(self, threshold: float, level: int) -> SurfaceMesh:
+        """メッシュを作って保持する（ワーカースレッドから呼ぶ）"""
+        mesh = extract_surface(self.levels[level], self.spacing, threshold)
+        self._meshes[(float(threshold), int(level))] = mesh
+        while len(self._meshes) > MESH_CACHE_SIZE:
+            self._meshes.popitem(last=False)
+        return mesh
+
+def get_mesh_cache(data) -> MeshCache:
+    """系列ごとに1つ作り、data.derived に保持する"""
+    if "meshes" not in data.derived:
+        data.derived["meshes"] = MeshCache(get_pyramid(data), data.voxel_spacing)
+    return data.derived["meshes"]
@@ -0,0 +1,57 @@
+import os
+import time
+from qtpy.QtCore import QTimer
+
+# 重い更新処理を実行する最大頻度（回/秒）。0以下で頻度制限なし（同じイベントループ周回内の要求だけまとめる）
+MAX_UPDATE_FPS = float(os.environ.get("DICOM_VIEWER_MAX_FPS", "60"))
+
+class UpdateScheduler:
+    """
+    スライダ等の changed で重い処理を即座に走らせず、処理ごとに最新の要求だけを残して
+    1フレームに1回までまとめて実行する。
+    ハンドラは実行時にウィジェットの現在値を読むので、途中の値は捨ててよい
+    """
+    def __init__(self, max_fps: float = MAX_UPDATE_FPS):
+        # 処理 -> 実行待ちの関数（同じ処理への要求は後勝ち）
+        self._pending: dict[object, object] = {}
+        self._timer = None
+        self._last_flush = 0.0
+        self.interval = 0.0
+        # 実行した更新数 / 実行前に新しい要求で上書きされて捨てた更新数
+        self.applied = 0
+        self.dropped = 0
+        self.set_max_fps(max_fps)
+
+    def set_max_fps(self, fps: float):
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+
+    def schedule(self, func, key=None):
+        """func の実行を予約する。key（既定は func 自身）が同じ予約が残っていれば置き換える"""
+        key = func if key is None else key
+        if key in self._pending:
+            self.dropped += 1
+        self._pending[key] = func
+
+        if self._timer is None:
+            self._timer = QTimer()
+            self._timer.setSingleShot(True)
+            self._timer.timeout.connect(self.flush)
+        if not self._timer.isActive():
+            # 前回の実行から1フレーム分経っていなければ、その分だけ待つ
+            wait = self._last_flush + self.interval - time.perf_counter()
+            self._timer.start(max(0, int(wait * 1000)))
+
+    def coalesced(self, func):
+        """シグナルに接続する用の関数を返す（引数は捨て、func の実行を予約するだけ）"""
+        return lambda *args: self.schedule(func)
+
+    def flush(self):
+        """予約済みの更新をすべて実行する"""
+        pending, self._pending = self._pending, {}
+        self._last_flush = time.perf_counter()
+        for func in pending.values():
+            func()
+            self.applied += 1
+
+# 全コントローラで共有するスケジューラ
+scheduler = UpdateScheduler()
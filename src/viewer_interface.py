@@ -1,50 +1,156 @@
+import time
 import napari
+import numpy as np
 from pathlib import Path # パス操作用にインポートを追加
-from magicgui.widgets import Container, Label, PushButton, SpinBox, Table, ComboBox, FloatSlider # FloatSliderを追加
+from magicgui.widgets import Container, Label, PushButton, SpinBox, ComboBox, FloatSlider, CheckBox # FloatSliderを追加
 
-from dicom_loader import load_dicom_series, DicomSeriesData
+from napari.qt.threading import create_worker
+
+from qtpy.QtCore import QTimer
+from qtpy.QtWidgets import QAction
+
+from dicom_loader import iter_load_dicom_files, expand_header_rows, slice_header_rows, DicomSeriesData, LoadProgress
+from volume_cache import VolumeCache
+from series_catalog import SeriesCatalog, SeriesInfo
+from pyramid import MAX_TEXTURE_SIZE
+from layer_pool import LayerPool
+from update_scheduler import scheduler
+from header_view import HeaderView
+from windowing import WindowingState, PRESETS, value_range_of
+from profiling import profiler, instrument
+from profile_panel import ProfilePanel
 from mode_2d import Slice2DController
 from mode_ortho import Ortho3DController
 from mode_volume import Volume3DController
 
+# スライス移動が止まってから、そのスライスのヘッダ表を読み込むまでの時間
+HEADER_FOLLOW_MS = 150
+# 右ドラッグでのウィンドウ調整の感度（1ピクセルあたり、値の範囲に対する割合）
+WINDOW_DRAG_SENSITIVITY = 1 / 1000
+
 class DicomViewerApp:
     def __init__(self):
         # 修正1: 初期タイトルを "DICOM Viewer" に変更
         self.viewer = napari.Viewer(title="DICOM Viewer")
         self.current_data: DicomSeriesData | None = None
+        # バックグラウンド読み込み中のワーカー
+        self.load_worker = None
+        self.load_folder: Path | None = None
+        # 一度開いた系列を次回メモリマップで開くためのキャッシュ
+        self.volume_cache = VolumeCache()
+        # フォルダ以下のシリーズ索引（再スキャンは変更のあったファイルだけ）
+        self.catalog = SeriesCatalog()
+        self.index_worker = None
         
-        # モード管理
+        # 全Imageレイヤー共通のウィンドウ設定（追加されたレイヤーは自動で従う）
+        self.windowing = WindowingState(self.viewer)
+
+        # モード管理（各モードのレイヤーはプールに保持し、切替時は表示/非表示だけ変える）
+        self.layer_pool = LayerPool(self.viewer)
         self.modes = {
-            "2D Slice Mode": Slice2DController(self.viewer),
-            "3D Orthogonal Mode": Ortho3DController(self.viewer),
-            "3D Volume Mode": Volume3DController(self.viewer)
+            "2D Slice Mode": Slice2DController(self.viewer, self.layer_pool, on_slice_changed=self._on_slice_changed),
+            "3D Orthogonal Mode": Ortho3DController(self.viewer, self.layer_pool),
+            "3D Volume Mode": Volume3DController(self.viewer, self.layer_pool)
         }
         self.current_mode_name = "2D Slice Mode"
 
         # --- Left Sidebar (DICOM Info) ---
         self.lbl_summary = Label(value="No Data")
-        self.tbl_header = Table(value=[], label="All DICOM Tags")
+        # 2Dモードで表示中のAxialスライスの情報（スライスごとの表から取るのでファイルは読まない）
+        self.lbl_slice = Label(value="")
+        # ヘッダ表は見えている行だけを描画するQtのモデル/ビュー（フィルタ欄つき）
+        self.header_view = HeaderView()
         
         self.left_container = Container(
             widgets=[
                 Label(value="--- Basic Info ---"),
                 self.lbl_summary,
-                Label(value="--- Header Details ---"),
-                self.tbl_header
+                Label(value="--- Current Slice ---"),
+                self.lbl_slice,
+                Label(value="--- Header Details ---")
             ],
             labels=False 
         )
+        self.left_container.native.layout().addWidget(self.header_view)
+        # ヘッダ表はスクロールが止まってから現在のスライスのものに切り替える
+        self.header_slice = None
+        self._header_timer = QTimer()
+        self._header_timer.setSingleShot(True)
+        self._header_timer.setInterval(HEADER_FOLLOW_MS)
+        self._header_timer.timeout.connect(self._show_slice_header)
         self.viewer.window.add_dock_widget(self.left_container, area="left", name="DICOM Info")
 
         # --- Right Sidebar (Control Panel) ---
         self._init_main_controls()
 
+        # 右ドラッグ: 横方向で W Width、縦方向で W Level を変える（全モード共通）
+        self.viewer.mouse_drag_callbacks.append(self._on_window_drag)
+
+        # --- Debug: 計測のドックとメニュー ---
+        self._init_profiling()
+
+    def _init_profiling(self):
+        self.profile_panel = ProfilePanel(on_session_stopped=self._on_profile_session_stopped)
+        self.profile_dock = self.viewer.window.add_dock_widget(
+            self.profile_panel.widget, area="right", name="Profiling")
+        menu = self.viewer.window.main_menu.addMenu("Debug")
+        self.action_profiling = QAction("Profiling", menu)
+        self.action_profiling.setCheckable(True)
+        self.action_profiling.toggled.connect(self._on_profiling_toggled)
+        menu.addAction(self.action_profiling)
+        self._hook_canvas_draw()
+        # DICOM_VIEWER_PROFILE=1 のときは起動時から表示する
+        self.action_profiling.setChecked(profiler.enabled)
+        self._on_profiling_toggled(profiler.enabled)
+
+    def _on_profiling_toggled(self, checked: bool):
+        profiler.enabled = checked or profiler.recording
+        self.profile_dock.setVisible(checked)
+        if checked:
+            self.profile_panel.start()
+        else:
+            self.profile_panel.stop()
+
+    def _on_profile_session_stopped(self):
+        # 記録中にメニューで計測を切っていた場合は、ここで計測も止める
+        profiler.enabled = self.action_profiling.isChecked()
+
+    def _hook_canvas_draw(self):
+        """キャンバスの描画（テクスチャの転送を含む）の所要時間を canvas.draw として記録する"""
+        qt_viewer = getattr(self.viewer.window, "_qt_viewer", None)
+        canvas = getattr(qt_viewer, "canvas", None)
+        # napariのバージョンによってはvispyのSceneCanvasをラップしている
+        canvas = getattr(canvas, "_scene_canvas", canvas)
+        draw = getattr(getattr(canvas, "events", None), "draw", None)
+        if draw is None: return
+        start = []
+        def on_begin(event):
+            if profiler.enabled:
+                start[:] = [time.perf_counter()]
+        def on_end(event):
+            if start:
+                t0 = start.pop()
+                profiler.record("canvas.draw", time.perf_counter() - t0, t0)
+        draw.connect(on_begin, position="first")
+        draw.connect(on_end, position="last")
+
     def _init_main_controls(self):
         self.btn_load = PushButton(text="Open DICOM Folder")
         self.btn_load.clicked.connect(self._open_folder)
         
+        # 遅延読み込み: 表示中のスライスだけをデコードする（RAMに収まらない系列向け）
+        self.chk_lazy = CheckBox(value=False, label="Lazy Loading (low memory)")
+        
         self.lbl_status = Label(value="Ready") 
 
+        self.btn_cancel = PushButton(text="Cancel Loading", enabled=False)
+        self.btn_cancel.clicked.connect(self._cancel_loading)
+
+        # フォルダ内に複数のシリーズがある場合に選ぶ
+        self.combo_series = ComboBox(choices=[], label="Series")
+        self.btn_load_series = PushButton(text="Load Series", enabled=False)
+        self.btn_load_series.clicked.connect(self._on_load_series_clicked)
+
         self.combo_mode = ComboBox(
             choices=list(self.modes.keys()),
             label="View Mode",
@@ -57,8 +163,21 @@ class DicomViewerApp:
         self.slider_wc = FloatSlider(value=40, min=-2000, max=8000, step=1, label="W Level")
         self.slider_ww = FloatSlider(value=400, min=1, max=8000, step=1, label="W Width")
         
-        self.slider_wc.changed.connect(self._update_contrast)
-        self.slider_ww.changed.connect(self._update_contrast)
+        # ドラッグ中の連続した changed は1フレームに1回へまとめる
+        self.slider_wc.changed.connect(scheduler.coalesced(self._update_contrast))
+        self.slider_ww.changed.connect(scheduler.coalesced(self._update_contrast))
+
+        # プリセット（Defaultは DICOMヘッダの推奨値）
+        self.combo_preset = ComboBox(choices=["Default"] + list(PRESETS), value="Default", label="Preset")
+        self.combo_preset.changed.connect(self._on_preset_change)
+
+        # --- Rendering: 3Dテクスチャの一辺の上限（超える場合は縮小した段を使う） ---
+        texture_choices = sorted({256, 512, 1024, 2048, 4096, 8192, MAX_TEXTURE_SIZE})
+        self.combo_texture = ComboBox(choices=texture_choices, value=MAX_TEXTURE_SIZE, label="Max Texture")
+        self.combo_texture.changed.connect(self._on_texture_size_change)
+        # オフにすると非表示のモードのレイヤーを解放する（切替は遅くなるがメモリを節約）
+        self.chk_keep_layers = CheckBox(value=True, label="Keep Hidden Modes")
+        self.chk_keep_layers.changed.connect(self._on_keep_layers_change)
 
         # リセット行の作成
         row_wc = self._create_reset_row(self.slider_wc, self._reset_wc)
@@ -66,7 +185,11 @@ class DicomViewerApp:
 
         widgets_list = [
             self.btn_load,
+            self.chk_lazy,
             self.lbl_status,
+            self.btn_cancel,
+            self.combo_series,
+            self.btn_load_series,
             Label(value="----------------"),
             self.combo_mode,
         ]
@@ -76,8 +199,12 @@ class DicomViewerApp:
 
         widgets_list.extend([
             Label(value="--- Windowing ---"),
+            self.combo_preset,
             row_wc,
-            row_ww
+            row_ww,
+            Label(value="--- Rendering ---"),
+            self.combo_texture,
+            self.chk_keep_layers
         ])
 
         self.container = Container(widgets=widgets_list)
@@ -101,68 +228,254 @@ class DicomViewerApp:
         if self.current_data:
             self.slider_ww.value = float(self.current_data.window_width)
 
+    def _on_window_drag(self, viewer, event):
+        if event.button != 2 or not self.current_data: return
+        # ドラッグ中はカメラのパン・ズームを止める（途中で例外が出ても必ず戻す）
+        camera = viewer.camera
+        mouse_pan, mouse_zoom = camera.mouse_pan, camera.mouse_zoom
+        camera.mouse_pan = camera.mouse_zoom = False
+        try:
+            lo, hi = self.windowing.value_range or (0.0, 1.0)
+            step = (hi - lo) * WINDOW_DRAG_SENSITIVITY
+            x0, y0 = event.pos
+            wc0, ww0 = self.slider_wc.value, self.slider_ww.value
+            yield
+            while event.type == "mouse_move":
+                x, y = event.pos
+                # スライダ経由で反映するので、更新は1フレームに1回にまとまる
+                self.slider_ww.value = float(np.clip(ww0 + (x - x0) * step, self.slider_ww.min, self.slider_ww.max))
+                self.slider_wc.value = float(np.clip(wc0 + (y - y0) * step, self.slider_wc.min, self.slider_wc.max))
+                yield
+        finally:
+            camera.mouse_pan, camera.mouse_zoom = mouse_pan, mouse_zoom
+
+    def _on_preset_change(self, event=None):
+        if self.combo_preset.value == "Default":
+            self._reset_wc()
+            self._reset_ww()
+        else:
+            self.slider_wc.value, self.slider_ww.value = PRESETS[self.combo_preset.value]
+        # 次のフレームを待たずにすぐ反映する
+        self._update_contrast()
+
     def _open_folder(self):
         from qtpy.QtWidgets import QFileDialog
         folder = QFileDialog.getExistingDirectory(None, "Select DICOM Folder")
         if folder:
-            try:
-                data = load_dicom_series(folder)
-                self.current_data = data
-                
-                # --- ウィンドウタイトルの更新 ---
-                folder_path = Path(folder)
-                folder_name = folder_path.name   # フォルダ名
-                series_name = data.series_description # DICOMヘッダの系列名
-                
-                # 修正2: タイトルを変更
-                self.viewer.title = f"{folder_name} - {series_name}"
-
-                # --- 左サイドバーの更新 ---
-                z, y, x = data.volume.shape
-                summary_text = (
-                    f"Size: {x} x {y}\n"
-                    f"Thickness: {data.slice_thickness} mm\n"
-                    f"Count: {z} slices"
-                )
-                self.lbl_summary.value = summary_text
-                self.tbl_header.value = data.header_data
-                
-                # --- 右サイドバー等の更新 ---
-                self.lbl_status.value = "Loaded"
-                
-                self._reset_wc()
-                self._reset_ww()
-
-                for mode in self.modes.values():
-                    mode.set_data(data)
-
-                self._refresh_view()
-
-            except Exception as e:
-                self.lbl_status.value = f"Error: {e}"
-                import traceback
-                traceback.print_exc()
+            self._detach_worker()
+            if self.index_worker is not None:
+                self.index_worker.returned.disconnect()
+                self.index_worker.errored.disconnect()
+                self.index_worker.quit()
+            self.load_folder = Path(folder)
+            self.lbl_status.value = "Indexing..."
+            self.btn_load_series.enabled = False
+
+            # サブフォルダも含めて索引を更新し、見つかったシリーズを一覧にする
+            worker = create_worker(self.catalog.index_folder, folder)
+            worker.returned.connect(self._on_index_done)
+            worker.errored.connect(self._on_load_error)
+            self.index_worker = worker
+            worker.start()
+
+    def _on_index_done(self, series: list[SeriesInfo]):
+        self.index_worker = None
+        self.combo_series.choices = [(info.label, info.series_uid) for info in series]
+        # 読めなかったファイルはファイルごとではなく件数だけを知らせる
+        skipped = f" ({self.catalog.skipped} unreadable files skipped)" if self.catalog.skipped else ""
+        if not series:
+            self.lbl_status.value = "No DICOM series found" + skipped
+            return
+        self.btn_load_series.enabled = True
+        if len(series) == 1:
+            self._load_series(series[0].series_uid)
+        else:
+            self.lbl_status.value = f"{len(series)} series found. Choose one and press Load Series" + skipped
+
+    def _on_load_series_clicked(self):
+        if self.combo_series.value is not None:
+            self._load_series(self.combo_series.value)
+
+    def _load_series(self, series_uid: str):
+        self._detach_worker()
+        files = self.catalog.series_files(series_uid, self.load_folder)
+        self.lbl_status.value = "Reading headers..."
+
+        # デコードはワーカースレッドで行い、届いたスライスから順に表示する
+        worker = create_worker(
+            iter_load_dicom_files, files, cache=self.volume_cache, lazy=self.chk_lazy.value
+        )
+        worker.yielded.connect(self._on_load_progress)
+        worker.returned.connect(self._on_load_done)
+        worker.errored.connect(self._on_load_error)
+        worker.aborted.connect(self._on_load_cancelled)
+        worker.finished.connect(self._on_load_finished)
+        self.load_worker = worker
+        self.btn_cancel.enabled = True
+        worker.start()
+
+    def _cancel_loading(self):
+        if self.load_worker is not None:
+            self.load_worker.quit()
+
+    def _detach_worker(self):
+        """読み込み中のワーカーを止め、以降の通知が新しい読み込みに混ざらないよう切り離す"""
+        if self.load_worker is None: return
+        worker = self.load_worker
+        for signal in (worker.yielded, worker.returned, worker.errored, worker.aborted, worker.finished):
+            signal.disconnect()
+        worker.quit()
+        self._on_load_finished()
 
+    def _on_load_progress(self, progress: LoadProgress):
+        if progress.data is not self.current_data:
+            # ヘッダ解析完了（またはキャッシュから読み込み）: 画面を組み立てる
+            self._show_data(progress.data)
+        elif self.current_mode_name == "2D Slice Mode":
+            self.modes[self.current_mode_name].on_slices_loaded(progress.indices)
+        self.lbl_status.value = f"Loading {progress.loaded} / {progress.total}"
+
+    def _on_load_done(self, data: DicomSeriesData):
+        self.lbl_status.value = "Loaded"
+        if not isinstance(data.volume, np.ndarray):
+            self.lbl_status.value = "Loaded (lazy)"
+        elif data.load_stats and data.load_stats.from_cache:
+            self.lbl_status.value = f"Loaded from cache ({data.load_stats.total_seconds * 1000:.0f} ms)"
+        elif data.load_stats:
+            self.lbl_status.value = f"Loaded ({data.load_stats.files_per_second:.0f} files/s)"
+            # 転送構文ごとの展開速度（圧縮形式・デコーダの違いを比べるため）。ステータスのツールチップに出す
+            if data.load_stats.syntax_summary:
+                self.lbl_status.tooltip = f"Decode: {data.load_stats.syntax_summary}"
+        if data.load_stats and data.load_stats.skipped:
+            self.lbl_status.value += f" - {data.load_stats.skipped} unreadable files skipped"
+        if data.load_stats and data.load_stats.series_count > 1:
+            self.lbl_status.value += (f" - {data.load_stats.series_count} series mixed, "
+                                      f"loaded the largest ({data.load_stats.file_count} slices)")
+        if data.load_stats and data.load_stats.progressive:
+            # 読み込み途中のボリュームから作った派生データは捨てる
+            # （キャッシュ・遅延読み込みは最初から完成しているので、作成済みのものをそのまま使う）
+            data.derived.clear()
+            # 3D系モードは読み込み途中のボリュームを表示しているので作り直す
+            self._release_3d_modes()
+
+    def _on_load_error(self, e: Exception):
+        self.lbl_status.value = f"Error: {e}"
+        import traceback
+        traceback.print_exception(e)
+
+    def _on_load_cancelled(self):
+        # 途中までのボリュームは診断に使えないので表示ごと破棄する
+        self.current_data = None
+        self.layer_pool.release_all()
+        # 各モードも途中のボリュームを手放す（モードを切り替えても作り直さない）
+        for mode in self.modes.values():
+            mode.set_data(None)
+        self.viewer.title = "DICOM Viewer"
+        self.lbl_summary.value = "No Data"
+        self.lbl_slice.value = ""
+        self._header_timer.stop()
+        self.header_view.set_rows([])
+        self.lbl_status.value = "Cancelled"
+
+    def _on_load_finished(self):
+        self.load_worker = None
+        self.btn_cancel.enabled = False
+
+    @instrument()
+    def _show_data(self, data: DicomSeriesData):
+        self.current_data = data
+        
+        # --- ウィンドウタイトルの更新 ---
+        folder_name = self.load_folder.name   # フォルダ名
+        series_name = data.series_description # DICOMヘッダの系列名
+        
+        # 修正2: タイトルを変更
+        self.viewer.title = f"{folder_name} - {series_name}"
+
+        # --- 左サイドバーの更新 ---
+        z, y, x = data.volume.shape
+        summary_text = (
+            f"Size: {x} x {y}\n"
+            f"Thickness: {data.slice_thickness} mm\n"
+            f"Spacing: {data.voxel_spacing[0]:.3g} mm\n"
+            f"Count: {z} slices"
+        )
+        for warning in data.geometry_warnings:
+            summary_text += f"\nWarning: {warning}"
+        self.lbl_summary.value = summary_text
+        self.header_view.set_rows(data.header_data, self._header_expander(data.header_path))
+        self.header_slice = None
+        self._on_slice_changed(z // 2)
+        
+        # --- 右サイドバー等の更新 ---
+        self.windowing.set_value_range(value_range_of(data))
+        self._reset_wc()
+        self._reset_ww()
+        self._update_contrast()
+
+        for mode in self.modes.values():
+            mode.set_data(data)
+
+        self._refresh_view()
+
+    def _header_expander(self, path: str | None):
+        """シーケンス行の展開関数。元ファイルが分からない系列（古いキャッシュ）では展開しない"""
+        if not path: return None
+        return lambda row: expand_header_rows(path, row["Path"], row.get("Depth", 0) + 1)
+
+    def _on_slice_changed(self, z: int):
+        data = self.current_data
+        if data is None or data.slices is None: return
+        self.lbl_slice.value = data.slices.describe(z)
+        self.header_slice = z
+        self._header_timer.start()
+
+    def _show_slice_header(self):
+        data = self.current_data
+        if data is None or data.slices is None or self.header_slice is None: return
+        try:
+            rows = slice_header_rows(data, self.header_slice)
+        except Exception as e:
+            # ファイルが移動・削除されていても表示は続ける
+            self.lbl_status.value = f"Cannot read slice header: {e}"
+            return
+        self.header_view.set_rows(rows, self._header_expander(data.slices.paths[self.header_slice]))
+
+    def _on_texture_size_change(self, event=None):
+        for name in ("3D Orthogonal Mode", "3D Volume Mode"):
+            self.modes[name].max_texture_size = self.combo_texture.value
+        self._release_3d_modes()
+
+    def _on_keep_layers_change(self, event=None):
+        self.layer_pool.keep_hidden = self.chk_keep_layers.value
+        if not self.layer_pool.keep_hidden:
+            self.layer_pool.release_hidden(self.modes[self.current_mode_name])
+
+    def _release_3d_modes(self):
+        """3D系モードのレイヤーを捨て、表示中なら作り直す"""
+        for name in ("3D Orthogonal Mode", "3D Volume Mode"):
+            self.layer_pool.release(self.modes[name])
+        if self.current_data and self.current_mode_name != "2D Slice Mode":
+            self._refresh_view()
+
+    @instrument()
     def _on_mode_change(self, event=None):
+        t0 = time.perf_counter()
         self.modes[self.current_mode_name].deactivate()
         self.current_mode_name = self.combo_mode.value
-        self.viewer.layers.clear()
         self.modes[self.current_mode_name].activate()
-        self._update_contrast()
+        if self.current_data:
+            self.lbl_status.value = f"Mode switched ({(time.perf_counter() - t0) * 1000:.0f} ms)"
 
     def _refresh_view(self):
-        self.viewer.layers.clear()
-        self.modes[self.current_mode_name].activate()
-        self._update_contrast()
+        # 現在のモードのレイヤーを作り直す
+        mode = self.modes[self.current_mode_name]
+        self.layer_pool.release(mode)
+        mode.activate()
 
     def _update_contrast(self):
-        wc = self.slider_wc.value
-        ww = self.slider_ww.value
-        lower = wc - (ww / 2)
-        upper = wc + (ww / 2)
-        for layer in self.viewer.layers:
-            if isinstance(layer, napari.layers.Image):
-                layer.contrast_limits = (lower, upper)
+        # 表示中のレイヤーのuniformだけを書き換える（非表示のレイヤーは表示時に反映される）
+        self.windowing.set_window(self.slider_wc.value, self.slider_ww.value)
 
 def run():
     app = DicomViewerApp()
@@ -0,0 +1,160 @@
+import os
+import json
+import hashlib
+import pydicom
+import numpy as np
+from pathlib import Path
+
+from slice_table import SliceTable
+from profiling import instrument
+
+# キャッシュの保存先と容量上限（MB）は環境変数で変更できる
+CACHE_DIR = Path(os.environ.get("DICOM_VIEWER_CACHE_DIR", Path.home() / ".dicom_viewer" / "cache"))
+CACHE_MAX_MB = int(os.environ.get("DICOM_VIEWER_CACHE_MB", "4096"))
+
+# 保存形式を変えたら上げる（古いエントリは別キーになり、いずれLRUで消える）
+CACHE_VERSION = 4
+
+def file_signature(files: list[Path]) -> list[tuple[str, int, int]]:
+    """
+    ファイルの (絶対パス, 更新時刻, サイズ) の一覧。ヘッダは読まない。
+    名前だけだと、同じ名前・サイズ・時刻のファイルを持つ別フォルダ（別の患者）を取り違える
+    """
+    sig = []
+    for f in files:
+        st = f.stat()
+        sig.append((str(Path(f).resolve()), st.st_mtime_ns, st.st_size))
+    sig.sort()
+    return sig
+
+def _series_uid_of(path: str) -> str | None:
+    """1ファイルだけヘッダを読んで SeriesInstanceUID を返す。読めなければ None"""
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=["SeriesInstanceUID"])
+    except Exception:
+        return None
+    return str(ds.get("SeriesInstanceUID", ""))
+
+def _digest(*parts) -> str:
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(json.dumps(p).encode("utf-8"))
+    return h.hexdigest()
+
+class VolumeCache:
+    """
+    組み立て済みボリュームを .npy として保存し、次回からメモリマップで開くキャッシュ。
+    エントリのキーは SeriesInstanceUID とファイルの更新時刻・サイズから作る。
+    全ヘッダを読まずに引けるよう、ファイル一覧の署名からキーへの参照(.ref)も置く（引くときは1ファイルだけ読んで系列を確かめる）
+    """
+    def __init__(self, root: Path = CACHE_DIR, max_mb: int = CACHE_MAX_MB):
+        self.root = Path(root)
+        self.max_bytes = max_mb * 1024 * 1024
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def make_key(self, series_uid: str, signature: list) -> str:
+        return _digest(CACHE_VERSION, series_uid, signature)
+
+    def lookup(self, signature: list) -> str | None:
+        """
+        ファイル一覧の署名から、以前保存したエントリのキーを探す。
+        エントリに記録したファイル一覧と SeriesInstanceUID（1ファイルだけ読んで確認）が一致した場合だけ返す
+        """
+        if not self.enabled: return None
+        ref = self.root / f"{_digest(CACHE_VERSION, signature)}.ref"
+        try:
+            key = ref.read_text().strip()
+            meta = json.loads((self.root / f"{key}.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            ref.unlink(missing_ok=True)
+            return None
+        files = [path for path, _, _ in signature]
+        if meta.get("files") != files or not files or _series_uid_of(files[0]) != meta.get("series_uid"):
+            return None
+        return key
+
+    @instrument("cache.load")
+    def load(self, key: str) -> tuple[np.ndarray, dict] | None:
+        """キャッシュからメモリマップでボリュームを開き、(volume, フィールド辞書)を返す。無ければNone"""
+        meta_path = self.root / f"{key}.json"
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            volume = np.load(self.root / f"{key}.npy", mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        # 最終利用時刻としてサイドカーの更新時刻を使う（LRU用）
+        os.utime(meta_path)
+        fields = meta["fields"]
+        if fields.get("slices") is not None:
+            fields["slices"] = SliceTable.from_dict(fields["slices"])
+        return volume, fields
+
+    @instrument("cache.store")
+    def store(self, key: str, signature: list, data, series_uid: str) -> None:
+        """ボリュームとメタデータを書き込み、容量上限を超えた分を古い順に消す"""
+        if not self.enabled: return
+        if data.volume.nbytes > self.max_bytes: return
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        fields = {
+            "pixel_spacing": data.pixel_spacing,
+            "slice_thickness": data.slice_thickness,
+            "series_description": data.series_description,
+            "header_data": data.header_data,
+            "window_center": data.window_center,
+            "window_width": data.window_width,
+            "slice_spacing": data.slice_spacing,
+            "geometry_warnings": data.geometry_warnings,
+            "value_range": data.value_range,
+            "header_path": data.header_path,
+            "slices": data.slices.to_dict() if data.slices is not None else None,
+        }
+        # 書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換える
+        tmp_npy = self.root / f"{key}.npy.tmp"
+        with open(tmp_npy, "wb") as f:
+            np.save(f, np.ascontiguousarray(data.volume))
+        os.replace(tmp_npy, self.root / f"{key}.npy")
+        tmp_meta = self.root / f"{key}.json.tmp"
+        meta = {
+            "version": CACHE_VERSION,
+            # lookup で照合する元ファイルの一覧と系列
+            "files": [path for path, _, _ in signature],
+            "series_uid": series_uid,
+            "fields": fields,
+        }
+        tmp_meta.write_text(json.dumps(meta), encoding="utf-8")
+        os.replace(tmp_meta, self.root / f"{key}.json")
+        (self.root / f"{_digest(CACHE_VERSION, signature)}.ref").write_text(key)
+
+        self.evict(keep=key)
+
+    def evict(self, keep: str | None = None) -> None:
+        """合計サイズが上限を超えていれば、最後に使われたのが古いものから削除する"""
+        entries = []
+        total = 0
+        for meta_path in self.root.glob("*.json"):
+            key = meta_path.stem
+            npy_path = self.root / f"{key}.npy"
+            try:
+                size = npy_path.stat().st_size + meta_path.stat().st_size
+                last_used = meta_path.stat().st_mtime
+            except OSError:
+                continue
+            entries.append((last_used, key, size))
+            total += size
+
+        entries.sort()
+        for _, key, size in entries:
+            if total <= self.max_bytes: break
+            if key == keep: continue
+            for suffix in (".npy", ".json"):
+                try:
+                    (self.root / f"{key}{suffix}").unlink(missing_ok=True)
+                except OSError:
+                    # Windowsではメモリマップ中のファイルは消せないので次回に回す
+                    break
+            else:
+                total -= size
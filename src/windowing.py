@@ -0,0 +1,80 @@
+import napari
+import numpy as np
+
+from profiling import instrument
+
+# よく使うウィンドウ (Level, Width) [HU]
+PRESETS = {
+    "Lung": (-600.0, 1500.0),
+    "Bone": (400.0, 1800.0),
+    "Brain": (40.0, 80.0),
+    "Abdomen": (40.0, 400.0),
+}
+
+def value_range_of(data) -> tuple[float, float]:
+    """系列の値の範囲。Modality LUT から求めた範囲が無ければ型の範囲を使う"""
+    if data.value_range is not None:
+        return tuple(float(v) for v in data.value_range)
+    if np.issubdtype(data.volume.dtype, np.integer):
+        info = np.iinfo(data.volume.dtype)
+        return float(info.min), float(info.max)
+    return 0.0, 1.0
+
+class WindowingState:
+    """
+    全Imageレイヤーで共有するウィンドウ設定。
+    viewer に追加されたImageレイヤーは自動的にこの設定に従う。
+    contrast_limits_range は系列の値の範囲に固定し、ドラッグ中は表示中のレイヤーの
+    contrast_limits（シェーダーのuniform）だけを書き換える。非表示のレイヤーは表示された時に合わせる
+    """
+    def __init__(self, viewer: napari.Viewer):
+        self.viewer = viewer
+        self.center = 40.0
+        self.width = 400.0
+        self.value_range = None
+        # レイヤーごとに最後に反映した contrast_limits（同じ値の再設定を省く）
+        self._applied: dict[int, tuple[float, float]] = {}
+        viewer.layers.events.inserted.connect(self._on_inserted)
+        viewer.layers.events.removed.connect(self._on_removed)
+
+    @property
+    def limits(self) -> tuple[float, float]:
+        return (self.center - self.width / 2, self.center + self.width / 2)
+
+    def set_value_range(self, value_range: tuple[float, float]):
+        self.value_range = value_range
+        self._applied.clear()
+
+    @instrument("windowing.set_window")
+    def set_window(self, center: float, width: float):
+        self.center, self.width = float(center), max(float(width), 1.0)
+        for layer in self.viewer.layers:
+            if isinstance(layer, napari.layers.Image) and layer.visible:
+                self._apply_to(layer)
+
+    def _apply_to(self, layer):
+        limits = self.limits
+        if self._applied.get(id(layer)) == limits: return
+        if id(layer) not in self._applied and self.value_range is not None:
+            # 範囲を先に固定しておくと、contrast_limits の変更で範囲の再計算が起きない
+            lo, hi = self.value_range
+            layer.contrast_limits_range = (min(lo, limits[0]), max(hi, limits[1]))
+        layer.contrast_limits = limits
+        self._applied[id(layer)] = limits
+
+    def _on_inserted(self, event):
+        layer = event.value
+        if not isinstance(layer, napari.layers.Image): return
+        layer.events.visible.connect(self._on_visible)
+        self._apply_to(layer)
+
+    def _on_removed(self, event):
+        layer = event.value
+        if not isinstance(layer, napari.layers.Image): return
+        layer.events.visible.disconnect(self._on_visible)
+        self._applied.pop(id(layer), None)
+
+    def _on_visible(self, event):
+        layer = event.source
+        if layer.visible:
+            self._apply_to(layer)